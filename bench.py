@@ -0,0 +1,104 @@
+"""Benchmarks for update-contacts-gdoc.py.
+
+    python bench.py startup          time each command until its first request
+    python bench.py scale [size ...] time each update stage on synthetic
+                                     directories, against fake_google
+"""
+
+import contextlib
+import importlib.util
+import io
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from fake_google import FakeBackend, fake_directory
+
+script = Path(__file__).with_name('update-contacts-gdoc.py')
+
+
+def load_script():
+    # The script's name isn't a valid module name, so import it by path.
+    spec = importlib.util.spec_from_file_location('update_contacts_gdoc', script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench_startup(ucg, repeats=5):
+    # Time each subcommand, in fresh processes, from interpreter start until it
+    #   is ready to send its first request.
+    print(f"{'command':<12}{'min (s)':>10}{'median (s)':>12}")
+    for command in ucg.command_services:
+        times = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, str(script), command, '--startup-probe'],
+                stdout=subprocess.DEVNULL, check=True
+            )
+            times.append(time.perf_counter() - start)
+        print(f"{command:<12}{min(times):>10.3f}{statistics.median(times):>12.3f}")
+
+def bench_scale(ucg, sizes):
+    # Run each stage of an update against a FakeBackend for synthetic
+    #   directories of each size, and print its wall time, API calls, payload
+    #   and peak memory above what earlier stages hold.
+    print(f"{'contacts':>8}  {'stage':<14}{'time (s)':>9}{'calls':>7}{'requests':>9}"
+          f"{'sent (kB)':>10}{'recv (kB)':>10}{'peak (MB)':>10}")
+    # Measure the work, not the Docs write quota.
+    ucg.docs_write_bucket = ucg.TokenBucket(float('inf'), float('inf'))
+    tracemalloc.start()
+    try:
+        for size in sizes:
+            rows, files = fake_directory(size)
+            # Simulating the document is quadratic; only record large runs.
+            backend = FakeBackend(rows, files, simulate=size <= 1000)
+            svcs = backend.services()
+            results = {}
+
+            stages = [
+                ('get_doc', lambda: ucg.get_doc(svcs['docs'], ucg.output_id)),
+                ('get_sheet', lambda: ucg.get_sheet(svcs['sheets'], ucg.sheet_id, ucg.contact_columns)),
+                ('get_photos', lambda: ucg.get_photos(svcs['drive'], ucg.pics_dir_id)),
+                ('create_abook', lambda: ucg.create_abook(results['get_sheet'], results['get_photos'])),
+                ('layout', lambda: list(ucg.layout_blocks(ucg.create_output_sections(results['create_abook'])))),
+                ('row_data', lambda: list(ucg.rebuild_requests(results['layout'], 1))),
+                ('send_requests', lambda: ucg.send_requests(svcs['docs'], ucg.output_id, results['row_data'])),
+            ]
+            for name, function in stages:
+                since = len(backend.calls)
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+                # Keep progress messages out of the report.
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results[name] = function()
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] - before
+                stats = backend.stats(since)
+                requests = len(results[name]) if name == 'row_data' else ''
+                print(
+                    f"{size:>8}  {name:<14}{elapsed:>9.3f}{stats['calls']:>7}{requests:>9}"
+                    f"{stats['request_bytes'] / 1024:>10.1f}"
+                    f"{stats['response_bytes'] / 1024:>10.1f}{peak / 2 ** 20:>10.1f}"
+                )
+    finally:
+        tracemalloc.stop()
+
+def main():
+    args = sys.argv[1:]
+    ucg = load_script()
+    if 'startup' in args:
+        bench_startup(ucg)
+    if 'scale' in args:
+        sizes = [int(a) for a in args if a.isdigit()]
+        bench_scale(ucg, sizes or [10, 1000, 50000])
+    if not {'startup', 'scale'} & set(args):
+        print(__doc__)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,414 @@
+"""Offline stand-ins for the Google services used by update-contacts-gdoc.py,
+for its tests and benchmarks."""
+
+import json
+import random
+import threading
+import time
+
+
+def utf16_len(text):
+    # Docs indexes count UTF-16 code units.
+    return len(text.encode('utf-16-le')) // 2
+
+# Structural markers of FakeDocument: table, row and cell starts, and the
+#   newline ending a table's last cell.
+TABLE = ('table',)
+ROW = ('row',)
+CELL = ('cell',)
+TABLE_END = ('\n', 'table end')
+
+class FakeDocument:
+    """In-memory Google Doc body that applies batchUpdate requests with the
+    same index arithmetic as Docs. The body is a list of one-index-long
+    tokens (characters, images and structural markers) starting at index 1,
+    after the section break."""
+
+    def __init__(self):
+        self.tokens = ['\n']
+        self.style = {}
+        self.revision = 0
+
+    def position(self, index, inside=True):
+        # Return the token position of "index"; with "inside", the index must
+        #   be inside a paragraph.
+        pos = index - 1
+        if not 0 <= pos < len(self.tokens):
+            raise ValueError(f"Index {index} is out of range.")
+        if inside and self.tokens[pos] in (TABLE, ROW, CELL):
+            raise ValueError(f"Index {index} is not inside a paragraph.")
+        return pos
+
+    def apply(self, request):
+        (kind, body), = request.items()
+        if kind == 'insertText':
+            pos = self.position(body['location']['index'])
+            tokens = []
+            for char in body['text']:
+                # Characters outside the BMP take two UTF-16 code units.
+                tokens.extend([char] if utf16_len(char) == 1 else [char, ''])
+            self.tokens[pos:pos] = tokens
+        elif kind == 'insertInlineImage':
+            pos = self.position(body['location']['index'])
+            self.tokens[pos:pos] = [('image', body['uri'])]
+        elif kind == 'insertTable':
+            pos = self.position(body['location']['index'])
+            tokens = ['\n', TABLE]
+            for r in range(body['rows']):
+                tokens.append(ROW)
+                tokens.extend([CELL, '\n'] * body['columns'])
+            tokens[-1] = TABLE_END
+            self.tokens[pos:pos] = tokens
+        elif kind == 'deleteContentRange':
+            start = self.position(body['range']['startIndex'], inside=False)
+            end = self.position(body['range']['endIndex'], inside=False)
+            depth = 0
+            for token in self.tokens[start:end]:
+                depth += (token == TABLE) - (token == TABLE_END)
+                if depth < 0:
+                    break
+            if depth or start >= end:
+                raise ValueError(f"Can't delete range {start + 1}-{end + 1}.")
+            del self.tokens[start:end]
+        elif kind == 'updateTableCellStyle':
+            pos = self.position(body['tableStartLocation']['index'], inside=False)
+            if self.tokens[pos] != TABLE:
+                raise ValueError(f"No table at index {pos + 1}.")
+        elif kind == 'updateTextStyle':
+            self.position(body['range']['startIndex'], inside=False)
+            self.position(body['range']['endIndex'] - 1, inside=False)
+        elif kind == 'updateDocumentStyle':
+            for field in body['fields'].split(','):
+                self.style[field] = body['documentStyle'][field]
+        else:
+            raise ValueError(f"Unsupported request {kind}.")
+
+    def to_json(self):
+        # Render the body in the structure returned by documents().get.
+        content = [{'startIndex': 0, 'endIndex': 1, 'sectionBreak': {}}]
+        objects = {}
+        pos = 0
+
+        def paragraph():
+            nonlocal pos
+            start = pos
+            elements = []
+            text = ''
+            while True:
+                token = self.tokens[pos]
+                pos += 1
+                if isinstance(token, tuple) and token[0] == 'image':
+                    if text:
+                        elements.append({'textRun': {'content': text}})
+                        text = ''
+                    obj_id = f"kix.{len(objects)}"
+                    objects[obj_id] = {'inlineObjectProperties': {'embeddedObject': {
+                        'imageProperties': {'sourceUri': token[1]},
+                    }}}
+                    elements.append({'inlineObjectElement': {'inlineObjectId': obj_id}})
+                else:
+                    text += token[0] if token == TABLE_END else token
+                if token in ('\n', TABLE_END):
+                    break
+            if text:
+                elements.append({'textRun': {'content': text}})
+            return {
+                'startIndex': start + 1,
+                'endIndex': pos + 1,
+                'paragraph': {'elements': elements},
+                'last': token == TABLE_END,
+            }
+
+        while pos < len(self.tokens):
+            if self.tokens[pos] != TABLE:
+                part = paragraph()
+                del part['last']
+                content.append(part)
+                continue
+            start = pos
+            pos += 1
+            rows = []
+            done = False
+            while not done:
+                pos += 1
+                cells = []
+                rows.append({'tableCells': cells})
+                while not done and self.tokens[pos] == CELL:
+                    pos += 1
+                    cell = []
+                    while not done and self.tokens[pos] not in (CELL, ROW):
+                        part = paragraph()
+                        done = part.pop('last')
+                        cell.append(part)
+                    cells.append({'content': cell})
+            content.append({
+                'startIndex': start + 1,
+                'endIndex': pos + 1,
+                'table': {
+                    'rows': len(rows),
+                    'columns': len(rows[0]['tableCells']),
+                    'tableRows': rows,
+                },
+            })
+        return {
+            'revisionId': str(self.revision),
+            'body': {'content': content},
+            'documentStyle': dict(self.style),
+            'inlineObjects': objects,
+        }
+
+def mask_fields(data, fields):
+    # Keep only the parts of an API response selected by a partial-response
+    #   field mask of comma-separated paths, as the APIs do.
+    if not fields:
+        return data
+    if isinstance(data, list):
+        return [mask_fields(item, fields) for item in data]
+    masked = {}
+    for path in fields.split(','):
+        key, _, rest = path.strip().partition('.')
+        if key in data:
+            value = mask_fields(data[key], rest) if rest else data[key]
+            if isinstance(value, dict) and isinstance(masked.get(key), dict):
+                masked[key].update(value)
+            else:
+                masked[key] = value
+    return masked
+
+class FakeRequest:
+    # Stand-in for googleapiclient's HttpRequest.
+
+    def __init__(self, backend, method, body, function):
+        self.backend = backend
+        self.method = method
+        self.methodId = method
+        self.uri = f"fake://{method}"
+        self.body = json.dumps(body)
+        self.function = function
+
+    def execute(self, http=None, num_retries=0):
+        return self.backend.call(self)
+
+class FakeResource:
+    # Resource object whose methods are looked up on the backend.
+
+    def __init__(self, backend, prefix):
+        self.backend = backend
+        self.prefix = prefix
+
+    def __getattr__(self, name):
+        method = f"{self.prefix}.{name}"
+        if name in ('documents', 'spreadsheets', 'values', 'files', 'permissions'):
+            return lambda: FakeResource(self.backend, method)
+        handler = getattr(self.backend, method.replace('.', '_'))
+
+        def make_request(**kwargs):
+            return FakeRequest(self.backend, method, kwargs, lambda: handler(**kwargs))
+        return make_request
+
+class FakeBackend:
+    """In-process stand-in for the Docs, Sheets and Drive services returned by
+    build_services. It serves "rows" as the contacts sheet and "files" as the
+    photo folder, keeps a FakeDocument updated by batchUpdate (or only records
+    the requests without "simulate"), and can add latency and transient
+    errors to every call."""
+
+    def __init__(self, rows, files, latency=0.0, error_rate=0.0, simulate=True):
+        self.rows = rows
+        self.files = files
+        self.latency = latency
+        self.error_rate = error_rate
+        self.simulate = simulate
+        self.document = FakeDocument()
+        self.documents = {}
+        # Drive parents and permissions of the files created or shared.
+        self.parents = {}
+        self.permissions = {}
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def services(self):
+        return {
+            'docs': FakeResource(self, 'docs'),
+            'sheets': FakeResource(self, 'sheets'),
+            'drive': FakeResource(self, 'drive'),
+        }
+
+    def call(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise ConnectionResetError(f"Injected error in {request.method}.")
+        with self.lock:
+            result = request.function()
+        self.calls.append({
+            'method': request.method,
+            'request_bytes': len(request.body),
+            'response_bytes': len(result) if isinstance(result, bytes) else len(json.dumps(result)),
+        })
+        return result
+
+    def stats(self, since=0):
+        # Summarize the calls made after the first "since" calls.
+        calls = self.calls[since:]
+        return {
+            'calls': len(calls),
+            'request_bytes': sum(c['request_bytes'] for c in calls),
+            'response_bytes': sum(c['response_bytes'] for c in calls),
+        }
+
+    # Docs.
+    def get_document(self, doc_id):
+        # The first document used is self.document; others are created as
+        #   they are used.
+        if doc_id not in self.documents:
+            self.documents[doc_id] = self.document if not self.documents else FakeDocument()
+        return self.documents[doc_id]
+
+    def docs_documents_create(self, body):
+        doc_id = f"fake-doc-{len(self.documents)}"
+        self.get_document(doc_id)
+        return {'documentId': doc_id, 'title': body.get('title', '')}
+
+    def docs_documents_get(self, documentId, fields=None):
+        document = self.get_document(documentId)
+        doc = document.to_json() if self.simulate else {
+            'revisionId': str(document.revision),
+            'body': {'content': [
+                {'startIndex': 0, 'endIndex': 1, 'sectionBreak': {}},
+                {'startIndex': 1, 'endIndex': 2, 'paragraph': {'elements': []}},
+            ]},
+            'documentStyle': dict(document.style),
+        }
+        return mask_fields(doc, fields)
+
+    def docs_documents_batchUpdate(self, documentId, body):
+        document = self.get_document(documentId)
+        required = body.get('writeControl', {}).get('requiredRevisionId')
+        if required and required != str(document.revision):
+            import httplib2
+            from googleapiclient.errors import HttpError
+            raise HttpError(
+                httplib2.Response({'status': 400}),
+                b'{"error": {"code": 400, "message": "The required revision ID does not match."}}',
+            )
+        if self.simulate:
+            for request in body['requests']:
+                document.apply(request)
+        document.revision += 1
+        return {
+            'documentId': documentId,
+            'replies': [{} for r in body['requests']],
+            'writeControl': {'requiredRevisionId': str(document.revision)},
+        }
+
+    # Sheets.
+    def sheets_spreadsheets_get(self, spreadsheetId, fields=None):
+        return {'sheets': [{'properties': {
+            'title': 'Sheet1',
+            'gridProperties': {
+                'rowCount': len(self.rows) + 100,
+                'columnCount': max(len(r) for r in self.rows),
+            },
+        }}]}
+
+    def sheets_spreadsheets_values_get(self, spreadsheetId, range):
+        return {'range': range, 'values': self.values(range)}
+
+    def sheets_spreadsheets_values_batchGet(self, spreadsheetId, ranges,
+                                            majorDimension='ROWS', fields=None):
+        value_ranges = []
+        for a1 in ranges:
+            values = self.values(a1)
+            value_ranges.append({'values': values} if values else {})
+        return {'valueRanges': value_ranges}
+
+    def values(self, a1):
+        # Return the rows of an "'Sheet'!A1:B2" range, trimmed like the API.
+        start, end = a1.split('!')[1].split(':')
+
+        def cell(ref):
+            letters = ref.rstrip('0123456789')
+            column = 0
+            for letter in letters:
+                column = column * 26 + ord(letter) - ord('A') + 1
+            return int(ref[len(letters):]) - 1, column - 1
+
+        (r1, c1), (r2, c2) = cell(start), cell(end)
+        values = []
+        for row in self.rows[r1:r2 + 1]:
+            row = row[c1:c2 + 1]
+            while row and row[-1] == '':
+                row = row[:-1]
+            values.append(row)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    # Drive.
+    def drive_files_list(self, q=None, fields=None, pageSize=100, pageToken=None,
+                         orderBy=None):
+        files = self.files
+        if orderBy == 'modifiedTime desc':
+            files = sorted(files, key=lambda f: f['modifiedTime'], reverse=True)
+        start = int(pageToken or 0)
+        result = {'files': files[start:start + pageSize]}
+        if start + pageSize < len(files):
+            result['nextPageToken'] = str(start + pageSize)
+        return result
+
+    def drive_files_get(self, fileId, fields=None):
+        return {
+            'id': fileId,
+            'version': '1',
+            'modifiedTime': '2021-01-01T00:00:00Z',
+            'parents': self.parents.get(fileId, ['folder']),
+        }
+
+    def drive_files_create(self, body, fields=None):
+        # Only Google Docs can be created.
+        assert body['mimeType'] == 'application/vnd.google-apps.document'
+        result = self.docs_documents_create({'title': body['name']})
+        file_id = result['documentId']
+        self.parents[file_id] = body.get('parents', [])
+        return {'id': file_id}
+
+    def drive_permissions_list(self, fileId, fields=None):
+        return {'permissions': self.permissions.get(fileId, [
+            {'type': 'user', 'role': 'owner', 'emailAddress': 'owner@example.org'},
+        ])}
+
+    def drive_permissions_create(self, fileId, body, sendNotificationEmail=None):
+        self.permissions.setdefault(fileId, []).append(body)
+        return dict(body, id=str(len(self.permissions[fileId])))
+
+    def drive_files_get_media(self, fileId):
+        # A 1x1 GIF.
+        return b'GIF89a\x01\x00\x01\x00\x00\x00\x00;'
+
+def fake_directory(count, seed=0):
+    # Generate a synthetic contacts sheet of "count" people and the files of
+    #   their photo folder.
+    rng = random.Random(seed)
+    teams = ['Admin', 'Finance'] + [f"Team {t}" for t in range(count // 40 + 1)]
+    rows = [['Team', 'Role', 'Last Name', 'First Name', 'Email', 'Skype Name', 'Phone', 'Notes']]
+    files = []
+    for i in range(count):
+        last = f"Last{i:06d}"
+        first = rng.choice(['Ann', 'Bob', 'Chloé', 'Dmitri', 'Eun-ji', 'Fatou'])
+        rows.append([
+            rng.choice(teams), 'Member', last, first, f"{first}.{last}@example.org",
+            rng.choice(['', f"live:{last}"]), f"+236 7{i:07d}", '',
+        ])
+        for size in range(rng.randint(0, 2)):
+            width = rng.choice([240, 800, 3024])
+            files.append({
+                'id': f"photo{i}_{size}",
+                'name': f"{last}, {first}_{size}.jpg",
+                'size': str(width * width // 3),
+                'webContentLink': f"https://drive.google.com/uc?id=photo{i}_{size}",
+                'hasThumbnail': True,
+                'imageMediaMetadata': {'width': width, 'height': width * 4 // 3},
+                'modifiedTime': f"2021-01-01T00:00:{size:02d}Z",
+            })
+    return rows, files
@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+from bench import load_script
+
+
+@pytest.fixture
+def ucg(tmp_path, monkeypatch):
+    # A fresh copy of the script, writing its journal and cache under tmp_path
+    #   and not waiting for the Docs write quota.
+    module = load_script()
+    monkeypatch.setattr(module, 'cache_dir', tmp_path / 'cache')
+    monkeypatch.setattr(module, 'journal_dir', tmp_path / 'journal')
+    monkeypatch.setattr(module, 'docs_write_bucket', module.TokenBucket(float('inf'), float('inf')))
+    monkeypatch.chdir(tmp_path)
+    return module
@@ -0,0 +1,112 @@
+import json
+import random
+
+from fake_google import FakeBackend, fake_directory
+
+
+def update(ucg, backend, doc_id, full=False):
+    svcs = backend.services()
+    ucg.update_doc(
+        doc_id, doc_svc=svcs['docs'], sht_svc=svcs['sheets'],
+        dir_svc=svcs['drive'], full=full
+    )
+    return backend.get_document(doc_id).tokens
+
+
+def test_incremental_updates_match_full_rebuilds(ucg):
+    # Change a synthetic directory at random, one edit per round: a contact's
+    #   phone, team or photo, or a contact added or removed. After each edit,
+    #   the incrementally updated document must match a full rebuild.
+    rng = random.Random(0)
+    rows, files = fake_directory(300)
+    teams = sorted({row[0] for row in rows[1:]})
+    backend = FakeBackend(rows, files)
+    update(ucg, backend, 'check', full=True)
+    for i in range(30):
+        row = rng.randrange(1, len(rows))
+        edit = rng.choice(['phone', 'team', 'photo', 'add', 'remove'])
+        if edit == 'phone':
+            rows[row][6] = f"+236 6{rng.randrange(10 ** 7):07d}"
+        elif edit == 'team':
+            rows[row][0] = rng.choice(teams)
+        elif edit == 'photo':
+            name = f"{rows[row][2]}, {rows[row][3]}"
+            kept = [f for f in files if not f['name'].startswith(name)]
+            files[:] = kept if len(kept) < len(files) else files + [dict(
+                files[0], id=f"added{i}", name=f"{name}.jpg"
+            )]
+        elif edit == 'add':
+            rows.insert(row, [
+                rng.choice(teams + ['New Team']), 'Member', f"Added{i:03d}",
+                'Zoë', '', '', '', '',
+            ])
+        else:
+            del rows[row]
+        incremental = update(ucg, backend, 'check')
+        full = update(ucg, FakeBackend(rows, files), 'check', full=True)
+        assert incremental == full, f"round {i + 1} ({edit})"
+
+
+def test_batches_respect_limits(ucg, monkeypatch):
+    # A single large table is split across batches within the limits, and
+    #   builds the same document as with the default limits.
+    monkeypatch.setattr(ucg, 'table_layout', 'single')
+    rows, files = fake_directory(300)
+    expected = update(ucg, FakeBackend(rows, files), 'doc', full=True)
+
+    monkeypatch.setattr(ucg, 'max_batch_requests', 50)
+    monkeypatch.setattr(ucg, 'max_batch_bytes', 8 * 1024)
+    backend = FakeBackend(rows, files)
+    batches = []
+    batch_update = backend.docs_documents_batchUpdate
+
+    def record(documentId, body):
+        batches.append(body['requests'])
+        return batch_update(documentId, body)
+    backend.docs_documents_batchUpdate = record
+
+    assert update(ucg, backend, 'doc', full=True) == expected
+    assert len(batches) > 1
+    for requests in batches:
+        assert len(requests) <= 50
+        assert len(json.dumps(requests)) <= 8 * 1024
+
+
+def test_sheet_rows_below_blank_windows_are_read(ucg):
+    rows, files = fake_directory(20)
+    rows[11:11] = [[] for i in range(2500)]
+    backend = FakeBackend(rows, files)
+    sheet = ucg.get_sheet(backend.services()['sheets'], 'sheet', ucg.contact_columns)
+    assert len([row for row in sheet[1:] if row]) == 20
+
+
+def test_sharded_directory_parts_are_shared_and_exported(ucg, monkeypatch):
+    monkeypatch.setattr(ucg, 'shard_size', 100)
+    rows, files = fake_directory(350)
+    backend = FakeBackend(rows, files)
+    backend.parents['index'] = ['shared-folder']
+    shared = [
+        {'type': 'user', 'role': 'owner', 'emailAddress': 'me@example.org'},
+        {'type': 'anyone', 'role': 'reader', 'allowFileDiscovery': False},
+        {'type': 'group', 'role': 'writer', 'emailAddress': 'staff@example.org'},
+    ]
+    backend.permissions['index'] = list(shared)
+    update(ucg, backend, 'index')
+
+    parts = ucg.load_shards()['index']['shards']
+    assert len(parts) > 1
+    for part in parts:
+        assert backend.parents[part['id']] == ['shared-folder']
+        assert backend.permissions[part['id']] == shared[1:]
+
+    exported = []
+    monkeypatch.setattr(ucg, 'export_pdf', lambda svc, doc_id, path: exported.append((doc_id, path)))
+    ucg.export_directory(None, 'index', 'directory.pdf')
+    assert exported == [(part['id'], f"directory-{i + 1}.pdf") for i, part in enumerate(parts)]
+
+    # Once the directory fits in one document, that is what is exported.
+    del rows[51:]
+    update(ucg, backend, 'index')
+    exported.clear()
+    ucg.export_directory(None, 'index', 'directory.pdf')
+    assert exported == [('index', 'directory.pdf')]
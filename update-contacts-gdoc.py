@@ -1,22 +1,123 @@
 #!/usr/bin/env python3
 
+import contextlib
+import functools
+import hashlib
+import itertools
+import json
+import math
+import os
 import pickle
+import random
+import re
 import sys
 import pprint
+import threading
+import time
+import unicodedata
 
 from pathlib import Path
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+# The Google client libraries are imported where they are needed, so that
+#   commands that don't use them start quickly.
 
 # If modifying these scopes, delete the file token.pickle.
+token_file = Path('token.pickle')
+# Access tokens are refreshed when they expire within this many seconds.
+token_refresh_margin = 300
 SCOPES = [
     'https://www.googleapis.com/auth/documents',
     'https://www.googleapis.com/auth/spreadsheets.readonly',
     'https://www.googleapis.com/auth/drive.metadata.readonly',
+    # Needed to export the directory to PDF.
+    'https://www.googleapis.com/auth/drive.readonly',
+    # Needed to create and share the parts of a large directory.
+    'https://www.googleapis.com/auth/drive.file',
 ]
 
+# PDF exports are downloaded in chunks of this many bytes.
+export_chunk_size = 4 * 1024 * 1024
+
+# Number of documents updated at the same time with "update --manifest".
+manifest_workers = 4
+
+# Number of photos downloaded at the same time by "render", and where they are
+#   kept between runs (scaled to display size if Pillow is installed).
+render_workers = 8
+
+# Limits for each documents().batchUpdate call.
+max_batch_requests = 500
+max_batch_bytes = 1024 * 1024
+
+# Google Docs allows 60 write requests per minute per user.
+docs_write_rate = 1.0
+docs_write_burst = 10
+
+# Retry transient errors with jittered exponential backoff.
+retry_statuses = {429, 500, 502, 503, 504}
+max_retries = 6
+max_backoff = 64
+
+# Sheet holding the contacts, the columns used from it, and the number of rows
+#   fetched per request.
+sheet_name = 'Sheet1'
+contact_columns = [
+    'Team', 'Role', 'Last Name', 'First Name', 'Email', 'Skype Name', 'Phone',
+]
+sheet_window = 1000
+
+# Other names that these columns may have in files read with "--source",
+#   compared without regard to case.
+column_aliases = {
+    'Team': ['Department', 'Group'],
+    'Role': ['Title', 'Job Title', 'Position'],
+    'Last Name': ['Surname', 'Family Name'],
+    'First Name': ['Given Name'],
+    'Email': ['E-mail', 'Email Address', 'E-mail Address'],
+    'Skype Name': ['Skype'],
+    'Phone': ['Phone Number', 'Telephone', 'Mobile'],
+}
+
+# Local cache of API responses, validated against each object's change token.
+cache_dir = Path('.cache')
+cache_max_entries = 50
+cache_max_bytes = 100 * 1024 * 1024
+
+# "watch": seconds between polls of the Drive change feed, quiet time to wait
+#   after the last relevant change before updating, and the state file that
+#   keeps the change feed's page token between runs.
+watch_interval = 60
+watch_debounce = 120
+watch_state_file = cache_dir / 'watch.json'
+
+# Journals of updates in progress, from which interrupted ones are resumed.
+journal_dir = cache_dir / 'journal'
+
+# Photos downloaded by "render".
+thumbnail_dir = cache_dir / 'thumbnails'
+
+# API versions of the services used; their parsed discovery documents are
+#   cached in cache_dir / 'discovery'.
+api_versions = {'docs': 'v1', 'sheets': 'v4', 'drive': 'v3'}
+
+# Services needed by each subcommand, used by the startup benchmark.
+command_services = {
+    'help': [],
+    'update': ['docs', 'sheets', 'drive'],
+    'data': ['sheets', 'drive'],
+    'body': ['docs'],
+    'docstyle': ['docs'],
+    'outline': ['docs'],
+    'table': ['docs'],
+    'export': ['drive'],
+    'watch': ['docs', 'sheets', 'drive'],
+    'match': ['sheets', 'drive'],
+    'render': ['sheets', 'drive'],
+}
+
+# Largest page size accepted by Drive files().list.
+drive_page_size = 1000
+
 ### Google object IDs to be used.
 
 # ACATBA Photo Directory TEMPLATE
@@ -35,6 +136,74 @@ pics_dir_id = '1gx5ak18CYgtO6lz9jDEhu3nD3zOIkPP7'
 # https://docs.google.com/document/d/1h0qzBSEDkH4Wan-4xKImW6oNCFNVvt7YcdzqMK4Rv7k
 output_id = '1h0qzBSEDkH4Wan-4xKImW6oNCFNVvt7YcdzqMK4Rv7k'
 
+# Layout of the directory: contacts per table row, photo size in points, and
+#   whether to build one table per team ('sections') or a 'single' table.
+row_width = 3
+photo_size = 140
+# Resolution that photos should have at photo_size, in dots per inch.
+photo_dpi = 150
+table_layout = 'sections'
+
+# Directories of more than shard_size contacts (0 for no limit) are split
+#   into several documents, with the output document listing them. Teams stay
+#   in one document unless they are larger than that; with shard_by_team,
+#   each team gets its own document. The documents used are kept in
+#   shards_file.
+shard_size = 2000
+shard_by_team = False
+shards_file = Path('shards.json')
+
+# Teams listed here come first in the directory, in this order; the others
+#   follow in the order they first appear in the sheet.
+section_order = ['Admin', 'Finance']
+# Columns to sort each team's contacts by, e.g. ('Last Name', 'First Name');
+#   None keeps the sheet order. section_sort_keys overrides it per team.
+default_sort_key = None
+section_sort_keys = {}
+
+# Photos are matched to contacts by name, ignoring case, accents, spacing and
+#   word order. Aliases map contact names to the differently spelled names of
+#   their photos; "match --save" adds the suggested ones. Names at least this
+#   similar (0 to 1) are suggested.
+photo_aliases_file = Path('photo-aliases.json')
+photo_match_cutoff = 0.8
+
+# Placeholder image used when a contact has no photo.
+placeholder_photo = 'https://drive.google.com/uc?id=1JE7lhkcRWPf0yrasVHu9S0qPWidsktvy&export=download'
+
+
+# Printed by "help".
+usage = """Usage: update-contacts-gdoc.py [command] [options]
+
+Commands:
+  update                 Update the directory document (the default).
+      --full             Rebuild the document instead of updating what changed.
+      --manifest m.json  Update every document listed in the manifest file.
+      --export [x.pdf]   Also save the updated directory as PDF.
+  watch                  Update the document when the sheet or photos change.
+  export [x.pdf]         Save the directory document as PDF.
+                         A directory split into parts is saved as x-1.pdf,
+                         x-2.pdf, ... (also for --export).
+  render [x.html|x.pdf]  Render the directory to a local HTML or PDF file.
+      --photos folder    Use the photos in a local folder instead of Drive.
+  match                  Report how the photos match the contacts.
+      --save ["Last, First" ...]
+                         Save the suggested matches of the contacts listed, or
+                         those confirmed one at a time, as photo aliases.
+  [doc|sheet|photos|template] data [id]
+                         Print the raw data of a file.
+  body, docstyle, outline, table
+                         Print parts of the template or directory document.
+  delete_range start end, delete_row start row column
+                         Edit the template.
+  help                   Show this text.
+
+Options:
+  --source file          Read the contacts from a .csv, .vcf or .xlsx file
+                         instead of the sheet (update, match and render).
+  --no-cache             Don't use or update the cache of API responses.
+  --profile [x.json]     Report time and API calls per stage when done."""
+
 
 def do_cmdline(args, infile_id=None, outfile_id=None):
     """Handle all cmdline options."""
@@ -43,20 +212,141 @@ def do_cmdline(args, infile_id=None, outfile_id=None):
     for help in {'help', '--help', '-h'}:
         if help in args:
             # Print help info and exit.
-            print("No help text yet...")
+            print(usage)
             exit(0)
 
+    if '--startup-probe' in args:
+        # Stop where the command would send its first request (see
+        #   bench.py).
+        startup_probe(args)
+        exit()
+
+    # "--profile [file.json]" reports where the time went when the run ends.
+    global profile
+    if '--profile' in args:
+        profile = Profile(option_value(args, '--profile', '.json', 'profile.json'))
+
+    # Responses are cached on disk unless "--no-cache" is given.
+    cache = None
+    if '--no-cache' not in args:
+        cache = ResponseCache()
+
+    # "--source file" reads the contacts from a local .csv, .vcf or .xlsx file
+    #   instead of the sheet.
+    source = None
+    if '--source' in args:
+        source = args[args.index('--source') + 1]
+
     # Handle options.
-    # "Update" is default option if none are given.
-    if "update" in args or len(args) == 1:
+    # "Update" is default option if no other command is given; options such
+    #   as "--full" or "--source file" still apply to it.
+    commands = set(command_services) | {'delete_range', 'delete_row'}
+    if "update" in args or not commands.intersection(args[1:]):
         """Update output document with current information."""
         # Build services.
         svc_dict = build_services(['docs', 'sheets', 'drive'])
         doc_svc = svc_dict['docs']
         sh_svc = svc_dict['sheets']
         dr_svc = svc_dict['drive']
-        # Update document.
-        update_doc(outfile_id, doc_svc=doc_svc, sht_svc=sh_svc, dir_svc=dr_svc)
+        if cache:
+            cache.dr_svc = dr_svc
+        # Update document; "--full" forces a complete rebuild.
+        full = '--full' in args
+        if '--manifest' in args:
+            # Update every document listed in the manifest file, exporting
+            #   those with a "pdf" path.
+            manifest = load_manifest(args[args.index('--manifest') + 1])
+            update_docs(
+                manifest, doc_svc=doc_svc, sht_svc=sh_svc, dir_svc=dr_svc,
+                full=full, cache=cache, source=source
+            )
+            exit()
+        update_doc(
+            outfile_id, doc_svc=doc_svc, sht_svc=sh_svc, dir_svc=dr_svc,
+            full=full, cache=cache, source=source
+        )
+        # "--export [file.pdf]" also saves the updated directory as PDF.
+        if '--export' in args:
+            path = option_value(args, '--export', '.pdf', 'directory.pdf')
+            export_directory(dr_svc, outfile_id, path)
+        exit()
+
+    if "watch" in args:
+        """Update the output document whenever the sheet or photos change."""
+        svc_dict = build_services(['docs', 'sheets', 'drive'])
+        if cache:
+            cache.dr_svc = svc_dict['drive']
+
+        def run_update():
+            update_doc(
+                outfile_id, doc_svc=svc_dict['docs'], sht_svc=svc_dict['sheets'],
+                dir_svc=svc_dict['drive'], cache=cache
+            )
+
+        try:
+            watch(svc_dict['drive'], run_update, cache=cache)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
+        exit()
+
+    if "match" in args:
+        """Report how the photos match the contacts."""
+        svc_dict = build_services(['sheets', 'drive'])
+        if cache:
+            cache.dr_svc = svc_dict['drive']
+        fetched = fetch_concurrently({
+            'sheet': contacts_task(svc_dict['sheets'], contact_columns, cache, source),
+            'photos': (get_photos, svc_dict['drive'], pics_dir_id, True, cache),
+        })
+        report = {}
+        create_abook(fetched['sheet'], fetched['photos'], report=report)
+        print_match_report(report, fetched['photos'])
+        # "--save ["Last, First" ...]" saves the suggested matches of the
+        #   contacts listed, or those confirmed one at a time, as aliases.
+        if '--save' in args and report['suggested']:
+            names = list(itertools.takewhile(
+                lambda a: not a.startswith('--'), args[args.index('--save') + 1:]
+            ))
+            confirmed = confirm_suggestions(report['suggested'], names)
+            if confirmed:
+                aliases = load_photo_aliases()
+                aliases.update(confirmed)
+                save_photo_aliases(aliases)
+            print(f"Saved {len(confirmed)} aliases to {photo_aliases_file}.")
+        exit()
+
+    if "render" in args:
+        """Render the directory to a local HTML or PDF file."""
+        path = option_value(args, 'render', ('.html', '.pdf'), 'directory.html')
+        # "--photos folder" uses local photo files instead of the Drive
+        #   folder; with "--source", no network access is needed.
+        photos_dir = None
+        if '--photos' in args:
+            photos_dir = args[args.index('--photos') + 1]
+        services = [] if source else ['sheets']
+        if not (photos_dir and source):
+            services.append('drive')
+        svc_dict = build_services(services) if services else {}
+        dr_svc = svc_dict.get('drive')
+        if cache:
+            cache.dr_svc = dr_svc
+        if photos_dir:
+            photos_task = (local_photos, photos_dir)
+        else:
+            photos_task = (get_photos, dr_svc, pics_dir_id, True, cache)
+        fetched = fetch_concurrently({
+            'sheet': contacts_task(svc_dict.get('sheets'), contact_columns, cache, source),
+            'photos': photos_task,
+        })
+        abook = create_abook(fetched['sheet'], fetched['photos'])
+        render_directory(abook, path, dr_svc, use_cache=cache is not None)
+        exit()
+
+    if "export" in args:
+        """Save the output document as PDF."""
+        svc_dict = build_services(['drive'])
+        path = option_value(args, 'export', '.pdf', 'directory.pdf')
+        export_directory(svc_dict['drive'], outfile_id, path)
         exit()
 
     if "data" in args:
@@ -87,58 +377,70 @@ def do_cmdline(args, infile_id=None, outfile_id=None):
                         exit(1)
                     break
 
-        # Build services.
-        svc_dict = build_services([file_type])
+        # Build services; the sheet's change token comes from Drive.
+        services = [file_type]
+        if cache and file_type == 'sheets':
+            services.append('drive')
+        svc_dict = build_services(services)
         svc = svc_dict[file_type]
+        if cache:
+            cache.dr_svc = svc_dict['drive']
 
         # Print data from file_type.
         print(f"Getting data from {object}...")
         if file_type == 'sheets':
-            data = get_sheet(svc, obj_id)
+            data = get_sheet(svc, obj_id, cache=cache)
         elif file_type == 'docs':
-            data = get_doc(svc, obj_id)
+            data = get_doc(svc, obj_id, cache=cache)
         elif file_type == 'drive':
-            data = get_photos(svc, obj_id)
+            data = get_photos(svc, obj_id, cache=cache)
         print(data)
         exit()
 
+    # The inspection commands share one download of each document, limited to
+    #   the parts they print.
+    doc_parts = {}
+    for command, doc_id, part in (
+            ('body', infile_id, 'body'),
+            ('docstyle', outfile_id, 'documentStyle'),
+            ('outline', infile_id, 'body'),
+            ('table', infile_id, 'body.content.table')):
+        if command in args:
+            doc_parts.setdefault(doc_id, set()).add(part)
+    docs = {}
+
+    def inspected_doc(doc_id):
+        if doc_id not in docs:
+            svc = build_services(['docs'])['docs']
+            parts = doc_parts[doc_id]
+            # Skip parts that another part already includes.
+            fields = ','.join(sorted(
+                p for p in parts if not any(p.startswith(q + '.') for q in parts)
+            ))
+            docs[doc_id] = get_doc(svc, doc_id, cache=cache, fields=fields)
+        return docs[doc_id]
+
     if "body" in args:
         """Print Google Doc body code."""
-        # Build services.
-        svc_dict = build_services(['docs'])
-        svc = svc_dict['docs']
-        # Get content.
-        body = get_doc(svc, infile_id)['body']
+        body = inspected_doc(infile_id)['body']
         pp = pprint.PrettyPrinter(depth=20)
         pp.pprint(body)
 
     if "docstyle" in args:
         """Print Google Doc documentStyle code."""
-        # Build services.
-        svc_dict = build_services(['docs'])
-        svc = svc_dict['docs']
-        # Get content.
-        body = get_doc(svc, outfile_id)['documentStyle']
+        body = inspected_doc(outfile_id)['documentStyle']
         pp = pprint.PrettyPrinter(depth=20)
         pp.pprint(body)
 
     if "outline" in args:
         """Print output outlining the body of the document."""
-        # Build services.
-        svc_dict = build_services(['docs'])
-        svc = svc_dict['docs']
-        # Get content.
-        body = get_doc(svc, infile_id)["body"]
+        body = inspected_doc(infile_id)["body"]
         pp = pprint.PrettyPrinter(depth=4)
         pp.pprint(body)
 
     if "table" in args:
         """Print the table from the template."""
-        # Build services.
-        svc_dict = build_services(['docs'])
-        svc = svc_dict['docs']
-        # Get content.
-        parts = get_doc(svc, infile_id)['body']['content']
+        parts = inspected_doc(infile_id)['body']['content']
         for part in parts:
             try:
                 pp = pprint.PrettyPrinter(depth=20)
@@ -173,13 +475,146 @@ def do_cmdline(args, infile_id=None, outfile_id=None):
         i_col = args[del_i + 3]
         response = delete_row(svc, infile_id, start, i_row, i_col)
 
-def update_doc(doc_id, doc_svc=None, sht_svc=None, dir_svc=None):
-    # Get document contents.
-    print("Gathering info on existing document...")
-    doc_before = get_doc(doc_svc, doc_id)
+
+class Profile:
+    """Per-stage timings and API call statistics collected for --profile.
+    Stages are the functions decorated with @profiled; API calls are counted
+    in the outermost stage running in their thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.quota = {}
+
+    def stage(self, name):
+        return self.stages.setdefault(name, {
+            'calls': 0,
+            'seconds': 0.0,
+            'api_calls': 0,
+            'api_seconds': 0.0,
+            'request_bytes': 0,
+            'response_bytes': 0,
+            'retries': 0,
+        })
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            stage = self.stage(name)
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+
+    def add_call(self, request, result, seconds, retries):
+        method = getattr(request, 'methodId', None) or 'unknown'
+        request_bytes = len(getattr(request, 'uri', '') or '')
+        request_bytes += len(getattr(request, 'body', '') or '')
+        if isinstance(result, bytes):
+            response_bytes = len(result)
+        else:
+            response_bytes = len(json.dumps(result))
+        # Each attempt counts against the API's per-minute quota.
+        if method == 'docs.documents.batchUpdate':
+            quota = 'docs write'
+        else:
+            quota = method.split('.')[0] + ' read'
+        with self.lock:
+            stage = self.stage(getattr(thread_state, 'stage', None) or 'other')
+            stage['api_calls'] += 1
+            stage['api_seconds'] += seconds
+            stage['request_bytes'] += request_bytes
+            stage['response_bytes'] += response_bytes
+            stage['retries'] += retries
+            self.quota[quota] = self.quota.get(quota, 0) + retries + 1
+
+    def finish(self):
+        # Print the breakdown and write it to self.path as JSON.
+        total = time.monotonic() - self.start
+        print(f"\n{'stage':<22}{'runs':>6}{'time (s)':>10}{'API calls':>10}"
+              f"{'API (s)':>9}{'sent (kB)':>10}{'recv (kB)':>10}{'retries':>8}")
+        for name, st in sorted(self.stages.items(), key=lambda i: -i[1]['seconds']):
+            print(
+                f"{name:<22}{st['calls']:>6}{st['seconds']:>10.3f}{st['api_calls']:>10}"
+                f"{st['api_seconds']:>9.3f}{st['request_bytes'] / 1024:>10.1f}"
+                f"{st['response_bytes'] / 1024:>10.1f}{st['retries']:>8}"
+            )
+        quota = ', '.join(f"{k}: {v}" for k, v in sorted(self.quota.items()))
+        print(f"Total {total:.3f}s; quota units used: {quota or 'none'}.")
+        with open(self.path, 'w') as f:
+            json.dump({
+                'total_seconds': total,
+                'stages': self.stages,
+                'quota_units': self.quota,
+            }, f, indent=2)
+        print(f"Profile written to {self.path}.")
+
+profile = None
+
+def profiled(function):
+    # Record the time spent in "function" when profiling, and attribute the
+    #   API calls made inside it to it unless an outer stage is running.
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if profile is None:
+            return function(*args, **kwargs)
+        outer = getattr(thread_state, 'stage', None)
+        if outer is None:
+            thread_state.stage = function.__name__
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.add_time(function.__name__, time.monotonic() - start)
+            thread_state.stage = outer
+    return wrapper
+
+def option_value(args, option, suffix, default):
+    # Return the argument following "option" if it ends with "suffix".
+    i = args.index(option)
+    if i + 1 < len(args) and args[i + 1].endswith(suffix):
+        return args[i + 1]
+    return default
+
+def update_doc(doc_id, doc_svc=None, sht_svc=None, dir_svc=None, full=False,
+               cache=None, abook=None, source=None):
+    # Get document contents, contacts and photos at the same time, unless
+    #   the contacts are given in "abook". They are read from the sheet, or
+    #   from the "source" file if given. A full rebuild only needs to know
+    #   where the document ends; that small response isn't worth caching.
+    resumed = resume_update(doc_svc, doc_id)
+    if resumed:
+        return
+    if resumed is None and full:
+        # The document may hold part of an interrupted rebuild; rebuilding it
+        #   all again would take as long as the first attempt.
+        print("Comparing with what it wrote instead of rebuilding.")
+        full = False
+    doc_args = (None, end_fields) if full else (cache, None)
+    if abook is None:
+        print("Gathering info on existing document and updated content...")
+        fetched = fetch_concurrently({
+            'document': (get_doc, doc_svc, doc_id, *doc_args),
+            'sheet': contacts_task(sht_svc, contact_columns, cache, source),
+            'photos': (get_photos, dir_svc, pics_dir_id, True, cache),
+        })
+        doc_before = fetched['document']
+        abook = create_abook(fetched['sheet'], fetched['photos'])
+    else:
+        print(f"Gathering info on document {doc_id}...")
+        doc_before = get_doc(doc_svc, doc_id, *doc_args)
+
+    shards = split_abook(abook)
+    if len(shards) > 1:
+        # The document becomes the index of the shards.
+        update_shards(doc_id, doc_before, shards, doc_svc, dir_svc, full=full)
+        return
+    state = load_shards().get(doc_id)
+    if state and state.get('parts'):
+        # The directory fits in the document again.
+        state['parts'] = 0
+        save_shards(doc_id, state)
 
     # Add new content.
-    print("Gathering updated content...")
     requests = []
 
     # Adjust document properties.
@@ -207,81 +642,652 @@ def update_doc(doc_id, doc_svc=None, sht_svc=None, dir_svc=None):
     requests.append(req_prop)
 
     # Build main content.
-    input_rows = get_sheet(sht_svc, sheet_id)
-    photos = get_photos(dir_svc, pics_dir_id)
-    abook = create_abook(input_rows, photos)
-    rows = create_output_rows(abook)
-    table_start_index = 1
-    last_cell_index = 16
-    rows.reverse()
-    for row in rows:
-        # Insert new doc table row.
-        requests.append(table_insert(table_start_index))
-        # Modify table row properties.
-        requests.append(table_update_borders(table_start_index + 1))
-        # Modify text properties.
-        requests.append(table_update_format(table_start_index, last_cell_index))
-        # Insert contact data.
-        requests.extend(row_data(row, last_cell_index))
-    req_title = ''
-    # requests.append(req_title)
-
-    # Empty the existing document.
-    print("Deleting current contents...")
+    blocks = layout_blocks(create_output_sections(abook))
     end = get_end(doc_before)
-    response = delete_all(doc_svc, doc_id, end)
 
-    # Execute update.
+    # Compare with the tables already in the document, if possible.
+    old_blocks = None
+    if not full:
+        old_blocks = doc_blocks(doc_before)
+        if old_blocks is None:
+            print("Existing document layout not recognized; rebuilding it.")
+
+    if old_blocks is None:
+        if end > 1:
+            print("Replacing current contents...")
+        requests = itertools.chain(requests, rebuild_requests(blocks, end))
+    else:
+        changes = diff_requests(old_blocks, list(blocks), end)
+        if not changes:
+            print("Document is already up to date.")
+            return
+        requests.extend(changes)
+
+    # Execute update. Requests are generated a table row at a time, journaled
+    #   (so that an interrupted update can be resumed, see resume_update) and
+    #   sent a batch at a time, so writing starts while the rest of the
+    #   directory, even of a single large table, is still being laid out.
+    journal = UpdateJournal(doc_id)
+    journal.start(doc_before.get('revisionId'))
     print("Writing updated content...")
-    result = send_requests(doc_svc, doc_id, requests)
+    requests = journal.record(requests)
+    result = send_requests(
+        doc_svc, doc_id, requests, journal=journal,
+        revision=doc_before.get('revisionId')
+    )
+    journal.finish()
     print("Done.")
 
-def build_services(services):
+def load_manifest(path):
+    # Read the list of directories to build: each entry has the "output_id" of
+    #   its document, an optional "filter" of {column: [accepted values]} and
+    #   an optional "pdf" path to export it to.
+    with open(path) as f:
+        manifest = json.load(f)
+    for entry in manifest:
+        if 'output_id' not in entry:
+            print(f"Manifest entry without \"output_id\": {entry}")
+            exit(1)
+        for column, values in entry.get('filter', {}).items():
+            if isinstance(values, str):
+                entry['filter'][column] = [values]
+    return manifest
+
+def filter_abook(abook, filters):
+    # Keep the contacts whose columns have one of the accepted values.
+    return {
+        name: contact for name, contact in abook.items()
+        if all(contact.get(c) in values for c, values in filters.items())
+    }
+
+def update_docs(manifest, doc_svc=None, sht_svc=None, dir_svc=None, full=False,
+                cache=None, source=None):
+    # Build every document of the manifest from a single read of the sheet (or
+    #   the "source" file) and the photo folder. Documents are updated
+    #   concurrently; their writes all go through docs_write_bucket, so
+    #   together they stay within the quota.
+    #   Entries with a "pdf" path are exported on a separate thread while the
+    #   workers go on with the next documents.
+    from concurrent.futures import ThreadPoolExecutor
+
+    columns = list(contact_columns)
+    for entry in manifest:
+        columns.extend(c for c in entry.get('filter', {}) if c not in columns)
+    print("Gathering updated content...")
+    fetched = fetch_concurrently({
+        'sheet': contacts_task(sht_svc, columns, cache, source),
+        'photos': (get_photos, dir_svc, pics_dir_id, True, cache),
+    })
+    abook = create_abook(fetched['sheet'], fetched['photos'])
+
+    def export(entry):
+        thread_state.http = worker_http()
+        export_directory(dir_svc, entry['output_id'], entry['pdf'])
+
+    def run(entry):
+        thread_state.http = worker_http()
+        try:
+            update_doc(
+                entry['output_id'], doc_svc=doc_svc, dir_svc=dir_svc, full=full,
+                cache=cache, abook=filter_abook(abook, entry.get('filter', {}))
+            )
+        finally:
+            thread_state.http = None
+        if entry.get('pdf'):
+            return export_pool.submit(export, entry)
+
+    start = time.monotonic()
+    failed = []
+    with ThreadPoolExecutor(max_workers=1) as export_pool, \
+            ThreadPoolExecutor(max_workers=manifest_workers) as pool:
+        futures = {pool.submit(run, entry): entry['output_id'] for entry in manifest}
+        exports = {}
+        for future, doc_id in futures.items():
+            try:
+                exports[doc_id] = future.result()
+            except Exception as e:
+                print(f"Updating {doc_id} failed: {e!r}")
+                failed.append(doc_id)
+        for doc_id, future in exports.items():
+            try:
+                if future:
+                    future.result()
+            except Exception as e:
+                print(f"Exporting {doc_id} failed: {e!r}")
+                failed.append(doc_id)
+    elapsed = time.monotonic() - start
+    print(
+        f"Updated {len(manifest) - len(failed)} of {len(manifest)} documents "
+        f"in {elapsed:.1f}s."
+    )
+    if failed:
+        exit(1)
+
+def split_abook(abook):
+    # Split the contacts into the shards of the directory: consecutive teams
+    #   (see create_output_sections) fill a shard up to shard_size contacts;
+    #   larger teams are split between rows. Return a list of abooks.
+    if not shard_size and not shard_by_team:
+        return [abook]
+    size = max(shard_size, row_width) if shard_size else float('inf')
+    shards = []
+    shard = {}
+    for rows in create_output_sections(abook):
+        rows = list(rows)
+        count = sum(map(len, rows))
+        if shard and (shard_by_team or len(shard) + count > size):
+            shards.append(shard)
+            shard = {}
+        for row in rows:
+            if len(shard) + len(row) > size:
+                shards.append(shard)
+                shard = {}
+            for contact in row:
+                shard[contact.name] = contact
+    if shard or not shards:
+        shards.append(shard)
+    return shards
+
+def update_shards(doc_id, doc_before, shards, doc_svc, dir_svc, full=False):
+    # Write each shard to its own document, in parallel, and make "doc_id" an
+    #   index linking to them. Documents are created as needed and reused by
+    #   later runs; shards whose contacts are unchanged, in documents that
+    #   weren't edited since, are skipped.
+    from concurrent.futures import ThreadPoolExecutor
+
+    state = load_shards().get(doc_id, {'shards': []})
+    saved = state['shards']
+    for i in range(len(saved), len(shards)):
+        part_id = create_part(dir_svc, doc_id, f"Contacts directory, part {i + 1}")
+        saved.append({'id': part_id, 'signature': None, 'revision': None})
+        print(f"Created document {part_id} for part {i + 1}.")
+        save_shards(doc_id, state)
+    state['parts'] = len(shards)
+
+    def update(i):
+        shard = shards[i]
+        entry = saved[i]
+        signature = abook_signature(shard)
+        thread_state.http = worker_http()
+        try:
+            if (not full and entry['signature'] == signature
+                    and doc_token(doc_svc, entry['id']) == entry['revision']):
+                return False
+            print(f"Updating part {i + 1} ({len(shard)} contacts)...")
+            update_doc(entry['id'], doc_svc=doc_svc, full=full, abook=shard)
+            entry['signature'] = signature
+            entry['revision'] = doc_token(doc_svc, entry['id'])
+            return True
+        finally:
+            thread_state.http = None
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=manifest_workers) as pool:
+        updated = sum(pool.map(update, range(len(shards))))
+    save_shards(doc_id, state)
+    elapsed = time.monotonic() - start
+    print(f"Updated {updated} of {len(shards)} parts in {elapsed:.1f}s.")
+    for entry in saved[len(shards):]:
+        print(f"Document {entry['id']} is no longer used.")
+
+    # List the parts in the index document.
+    lines = []
+    for i, shard in enumerate(shards):
+        teams = list(dict.fromkeys(c['Team'] for c in shard.values()))
+        label = teams[0] if len(teams) == 1 else f"{teams[0]} \u2013 {teams[-1]}"
+        lines.append((f"Part {i + 1}: {label} ({len(shard)} contacts)", saved[i]['id']))
+    signature = hashlib.sha1(json.dumps(lines).encode()).hexdigest()
+    if not full and state.get('index') == signature and doc_before.get('revisionId') == state.get('index_revision'):
+        print("Index is already up to date.")
+        return
+    print("Writing index...")
+    send_requests(
+        doc_svc, doc_id, index_requests(lines, get_end(doc_before)),
+        revision=doc_before.get('revisionId')
+    )
+    state['index'] = signature
+    state['index_revision'] = doc_token(doc_svc, doc_id)
+    save_shards(doc_id, state)
+    print("Done.")
+
+def create_part(svc, doc_id, title):
+    # Create a document in the folders of "doc_id", shared with the same
+    #   people, so that whoever can read the index can open its links.
+    meta = execute(svc.files().get(fileId=doc_id, fields='parents'))
+    result = execute(svc.files().create(
+        body={
+            'name': title,
+            'mimeType': 'application/vnd.google-apps.document',
+            'parents': meta.get('parents', []),
+        },
+        fields='id',
+    ))
+    part_id = result['id']
+    permissions = execute(svc.permissions().list(
+        fileId=doc_id,
+        fields='permissions(type,role,emailAddress,domain,allowFileDiscovery)',
+    ))
+    for permission in permissions.get('permissions', []):
+        if permission['role'] == 'owner':
+            continue
+        options = {}
+        if permission['type'] in ('user', 'group'):
+            options['sendNotificationEmail'] = False
+        execute(svc.permissions().create(fileId=part_id, body=permission, **options))
+    return part_id
+
+def index_requests(lines, end):
+    # Replace the body, which ends at "end", with a title and one linked line
+    #   per (text, document id) in "lines".
+    requests = []
+    if end > 1:
+        requests.append(delete_request(1, end))
+    title = "Contacts directory\n"
+    text = title + ''.join(f"{line}\n" for line, doc_id in lines)
+    requests.append({'insertText': {'text': text, 'location': {'index': 1}}})
+    index = 1 + utf16_len(title)
+    for line, doc_id in lines:
+        length = utf16_len(line)
+        requests.append({
+            'updateTextStyle': {
+                'range': {'startIndex': index, 'endIndex': index + length},
+                'textStyle': {'link': {
+                    'url': f"https://docs.google.com/document/d/{doc_id}/edit"
+                }},
+                'fields': 'link',
+            }
+        })
+        index += length + 1
+    return requests
+
+def abook_signature(abook):
+    # Hash of the tables that update_doc would build for "abook".
+    blocks = layout_blocks(create_output_sections(abook))
+    signature = [block_signature(rows) for rows in blocks]
+    return hashlib.sha1(json.dumps(signature).encode()).hexdigest()
+
+shards_lock = threading.Lock()
+
+def load_shards():
+    try:
+        with open(shards_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_shards(doc_id, state):
+    # Save the shards of "doc_id"; other directories (see update_docs) may be
+    #   saving theirs at the same time.
+    with shards_lock:
+        shards = load_shards()
+        shards[doc_id] = state
+        tmp = shards_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(shards, f, indent=2)
+        os.replace(tmp, shards_file)
+
+def fetch_concurrently(tasks):
+    # Run each {name: (function, *args)} task in its own thread, with its own
+    #   HTTP transport, and return {name: result}. Print how long each took.
+    timings = {}
+
+    def run(name, function, *args):
+        start = time.monotonic()
+        thread_state.http = worker_http()
+        try:
+            return function(*args)
+        finally:
+            thread_state.http = None
+            timings[name] = time.monotonic() - start
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = {name: pool.submit(run, name, *task) for name, task in tasks.items()}
+        results = {name: future.result() for name, future in futures.items()}
+    elapsed = time.monotonic() - start
+    details = ', '.join(f"{name} {timings[name]:.1f}s" for name in tasks)
+    print(f"Fetched {details} ({elapsed:.1f}s total).")
+    return results
+
+def layout_blocks(sections):
+    # Yield the rows of each table of the document, a section at a time.
+    if table_layout == 'single':
+        yield [row for rows in sections for row in rows]
+        return
+    for rows in map(list, sections):
+        if rows:
+            yield rows
+
+def rebuild_requests(blocks, end):
+    # Yield the requests that replace the body, which ends at "end", with a
+    #   table for each block. The old contents are deleted in the same batch
+    #   as the first new content, so the document is never left empty
+    #   between calls.
+    if end > 1:
+        yield delete_request(1, end)
+    yield from table_requests(blocks, 1)
+
+def table_requests(blocks, location):
+    # Yield the requests that insert a table for each block, one after the
+    #   other, starting at "location".
+    for rows in blocks:
+        location = yield from block_requests(rows, location)
+
+def block_requests(rows, location):
+    # Yield the requests that build one table for "rows" (lists of up to
+    #   row_width contacts), each shown as a row of photos above a row of
+    #   contact details, a row at a time. The table's leading newline is
+    #   inserted at "location", so the table starts at location + 1. Return
+    #   (as the value of "yield from") the index where the table ends, which
+    #   is where the next table can be inserted.
+    start = location + 1
+    # Table start, then each row: row start + (cell start + newline) per cell.
+    end = start + 1 + 2 * len(rows) * (1 + 2 * row_width)
+    yield table_insert(location, 2 * len(rows), row_width)
+    yield table_update_borders(start)
+    # Table start, row start and cell start precede the first paragraph.
+    yield table_update_format(start + 3, end)
+    index = start + 3
+    for row in rows:
+        reqs, index = row_data(row, index)
+        yield from reqs
+    # "index" is now past the (nonexistent) next row's row and cell starts.
+    return index - 2
+
+def doc_blocks(doc):
+    # Return the contact tables of a document built by update_doc as a list of
+    #   {'start', 'end', 'signature'} dicts, or None if the body contains
+    #   anything else than empty paragraphs separating the tables.
+    images = {}
+    for obj_id, obj in doc.get('inlineObjects', {}).items():
+        props = obj['inlineObjectProperties']['embeddedObject']
+        images[obj_id] = props.get('imageProperties', {}).get('sourceUri')
+
+    blocks = []
+    for part in doc['body']['content']:
+        if 'sectionBreak' in part:
+            continue
+        elif 'paragraph' in part:
+            if cell_content([part], images) != ('\n', ()):
+                return None
+        elif 'table' in part:
+            table = part['table']
+            if table['columns'] != row_width:
+                return None
+            signature = tuple(
+                tuple(cell_content(c['content'], images) for c in r['tableCells'])
+                for r in table['tableRows']
+            )
+            blocks.append({
+                'start': part['startIndex'],
+                'end': part['endIndex'],
+                'signature': signature,
+            })
+        else:
+            return None
+    return blocks
+
+def cell_content(content, images):
+    # Reduce structural elements to their text and the source URIs of their
+    #   inline images.
+    text = ''
+    uris = []
+    for part in content:
+        if 'paragraph' not in part:
+            return (None, ())
+        for elem in part['paragraph']['elements']:
+            if 'textRun' in elem:
+                text += elem['textRun']['content']
+            elif 'inlineObjectElement' in elem:
+                uris.append(images.get(elem['inlineObjectElement']['inlineObjectId']))
+    return (text, tuple(uris))
+
+def block_signature(rows):
+    # Return the cell contents that block_requests will produce for these
+    #   rows, in the same form as doc_blocks reads them back from the document.
+    signature = []
+    empty = [('\n', ())] * row_width
+    for row in rows:
+        photo_cells = [('\n', (c.photo or placeholder_photo,)) for c in row]
+        text_cells = [(contact_text(c) + '\n', ()) for c in row]
+        signature.append(tuple((photo_cells + empty)[:row_width]))
+        signature.append(tuple((text_cells + empty)[:row_width]))
+    return tuple(signature)
+
+@profiled
+def diff_requests(old_blocks, blocks, end):
+    # Send only the changes needed to turn the existing tables into the new
+    #   blocks of rows. Changes are applied from the end of the document
+    #   backwards so that the indexes of earlier tables stay valid.
+    import difflib
+
+    old_sigs = [b['signature'] for b in old_blocks]
+    new_sigs = [block_signature(rows) for rows in blocks]
+    matcher = difflib.SequenceMatcher(None, old_sigs, new_sigs, autojunk=False)
+    requests = []
+    inserted = 0
+    deleted = 0
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            continue
+        deleted += i2 - i1
+        inserted += j2 - j1
+        # Each table is preceded by an empty paragraph; new tables are inserted
+        #   at the start of that paragraph (or of the final one).
+        if i1 < len(old_blocks):
+            location = old_blocks[i1]['start'] - 1
+        else:
+            location = end
+        if i2 > i1:
+            requests.append({
+                "deleteContentRange": {
+                    "range": {
+                        "startIndex": location,
+                        "endIndex": old_blocks[i2 - 1]['end'],
+                    }
+                }
+            })
+        requests.extend(table_requests(blocks[j1:j2], location))
+    if requests:
+        print(f"Replacing {deleted} tables with {inserted} of {len(blocks)} new tables...")
+    return requests
+
+@profiled
+def build_services(services, creds=None):
     # Initialize variables.
     doc_service = None
     sh_service = None
     dr_service = None
     # Build necessary services.
     print(f"Building service objects for {', '.join(services)}...")
-    creds = get_creds(SCOPES)
+    if creds is None:
+        creds = get_creds(SCOPES)
     if 'docs' in services:
-        doc_service = build('docs', 'v1', credentials=creds)
+        doc_service = build_service('docs', creds)
     if 'sheets' in services:
-        sh_service = build('sheets', 'v4', credentials=creds)
+        sh_service = build_service('sheets', creds)
     if 'drive' in services:
-        dr_service = build('drive', 'v3', credentials=creds)
+        dr_service = build_service('drive', creds)
     return {
         'docs': doc_service,
         'sheets': sh_service,
         'drive': dr_service,
     }
 
+def build_service(api, creds):
+    # Build a service object from the cached discovery document; reuse it if
+    #   the same service is requested again in this process.
+    from googleapiclient.discovery import build_from_document
+    key = (api, id(creds))
+    if key not in built_services:
+        built_services[key] = build_from_document(
+            discovery_document(api), credentials=creds
+        )
+    return built_services[key]
+
+built_services = {}
+
+def discovery_document(api):
+    # Return the parsed discovery document for "api", keeping a pickled copy
+    #   so that later runs neither fetch nor parse its JSON.
+    version = api_versions[api]
+    path = cache_dir / 'discovery' / f"{api}.{version}.pickle"
+    if path.is_file():
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    try:
+        # Documents bundled with google-api-python-client >= 2.0.
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc(api, version)
+    except ImportError:
+        content = None
+    if content is None:
+        import urllib.request
+        url = f"https://{api}.googleapis.com/$discovery/rest?version={version}"
+        with urllib.request.urlopen(url) as f:
+            content = f.read().decode()
+    document = json.loads(content)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, 'wb') as f:
+        pickle.dump(document, f)
+    os.replace(tmp, path)
+    return document
+
+def startup_probe(args):
+    # Import and build everything the command in "args" needs before its first
+    #   request, using anonymous credentials so no network access is needed.
+    from google.auth.credentials import AnonymousCredentials
+    for command, services in command_services.items():
+        if command in args:
+            build_services(services, creds=AnonymousCredentials())
+            break
+
+@profiled
 def get_creds(scopes):
-    creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-    if Path('token.pickle').is_file():
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
+    # Return the user's credentials. They are loaded once per process and
+    #   shared by all service objects and threads (see CredentialManager).
+    global credentials
+    if credentials is None:
+        credentials = CredentialManager(scopes)
+    return credentials.get()
+
+class CredentialManager:
+    """Hold the credentials of the process. The access token is refreshed
+    under a lock shortly before it expires, so that threads don't refresh it
+    at the same time and long updates don't fail halfway with 401 errors.
+    The token file is locked while it is refreshed and replaced atomically,
+    so that concurrent runs reuse each other's tokens instead of racing."""
+
+    def __init__(self, scopes, path=None):
+        self.scopes = scopes
+        self.path = path or token_file
+        self.creds = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        # Return the credentials, refreshed first if they expire soon.
+        if self.creds is None or self.expiring(self.creds):
+            with self.lock:
+                if self.creds is None:
+                    self.creds = self.load()
+                if self.expiring(self.creds):
+                    self.refresh()
+        return self.creds
+
+    def expiring(self, creds):
+        import datetime
+        if not creds.token:
+            return True
+        if creds.expiry is None:
+            return False
+        # google-auth keeps expiry as a naive UTC datetime.
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (creds.expiry - now).total_seconds() < token_refresh_margin
+
+    def load(self):
+        # Read the stored credentials; if there are none that can be used or
+        #   refreshed, let the user log in.
+        creds = self.read()
+        # Tokens stored before a scope was added to SCOPES can't be used for it.
+        if creds and not creds.has_scopes(self.scopes):
+            print("Stored token lacks some of the needed permissions; please log in again.")
+            creds = None
+        if not creds or not (creds.valid or creds.refresh_token):
+            from google_auth_oauthlib.flow import InstalledAppFlow
             flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', scopes)
+                'credentials.json', self.scopes)
             creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-    return creds
-
-def get_doc(svc, doc_id):
-    # Retrieve the documents contents from the Docs service.
-    doc_dict = svc.documents().get(documentId=doc_id).execute()
+            with self.file_lock():
+                self.write(creds)
+        return creds
+
+    def refresh(self):
+        from google.auth.transport.requests import Request
+        with self.file_lock():
+            # Another run may have refreshed the token while we waited.
+            stored = self.read()
+            if stored and stored.refresh_token and not self.expiring(stored):
+                self.creds.token = stored.token
+                self.creds.expiry = stored.expiry
+                return
+            print("Refreshing access token...")
+            self.creds.refresh(Request())
+            self.write(self.creds)
+
+    def read(self):
+        # The token file stores the user's access and refresh tokens, and is
+        #   created when the authorization flow completes for the first time.
+        if not self.path.is_file():
+            return None
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
+
+    def write(self, creds):
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            pickle.dump(creds, f)
+        os.replace(tmp, self.path)
+
+    @contextlib.contextmanager
+    def file_lock(self):
+        # Hold an exclusive lock on a file next to the token file, where
+        #   supported.
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(self.path.with_suffix('.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+@profiled
+def get_doc(svc, doc_id, cache=None, fields=None):
+    # Retrieve the documents contents from the Docs service, or only the parts
+    #   in the "fields" mask (e.g. 'body.content.endIndex').
+    if cache:
+        token = doc_token(svc, doc_id)
+        doc_dict = cache.get('doc', doc_id, token, extra=fields)
+        if doc_dict is not None:
+            return doc_dict
+    if fields:
+        doc_dict = execute(svc.documents().get(documentId=doc_id, fields=fields))
+    else:
+        doc_dict = execute(svc.documents().get(documentId=doc_id))
+    if cache:
+        cache.put('doc', doc_id, token, doc_dict, extra=fields)
     return doc_dict
 
+# The parts of a document that a full rebuild needs: its revision, for the
+#   update journal, and where it ends, for get_end.
+end_fields = 'revisionId,body.content.endIndex'
+
 def get_end(doc):
     # Return index of end position.
     last = doc['body']['content'][-1]['endIndex']
@@ -289,77 +1295,874 @@ def get_end(doc):
     end = last - 1
     return end
 
-def get_sheet(svc, sheet_id):
-    sheet_range = 'Sheet1!A1:Z500'
-    result = svc.spreadsheets().values().get(
-        spreadsheetId=sheet_id, range=sheet_range
-    ).execute()
-    rows = result.get('values', [])
-    return rows
+@profiled
+def get_sheet(svc, sheet_id, columns=None, cache=None):
+    return list(iter_sheet(svc, sheet_id, columns=columns, cache=cache))
+
+def iter_sheet(svc, sheet_id, columns=None, cache=None):
+    # Yield the header row and then each data row of the contacts sheet,
+    #   fetching only the given header "columns" (all columns if None) in
+    #   windows of "sheet_window" rows.
+    if not cache or not cache.dr_svc:
+        yield from fetch_sheet(svc, sheet_id, columns)
+        return
+    token = drive_token(cache.dr_svc, sheet_id)
+    rows = cache.get('sheet', sheet_id, token, extra=columns)
+    if rows is not None:
+        yield from rows
+        return
+    rows = []
+    for row in fetch_sheet(svc, sheet_id, columns):
+        rows.append(row)
+        yield row
+    cache.put('sheet', sheet_id, token, rows, extra=columns)
+
+def fetch_sheet(svc, sheet_id, columns):
+    meta = execute(svc.spreadsheets().get(
+        spreadsheetId=sheet_id,
+        fields='sheets.properties(title,gridProperties(rowCount,columnCount))',
+    ))
+    sheets = [s['properties'] for s in meta['sheets']]
+    props = next((p for p in sheets if p['title'] == sheet_name), sheets[0])
+    title = "'" + props['title'].replace("'", "''") + "'"
+    row_count = props['gridProperties']['rowCount']
+    col_count = props['gridProperties']['columnCount']
+
+    # Map the header names to column indexes.
+    result = execute(svc.spreadsheets().values().get(
+        spreadsheetId=sheet_id, range=f"{title}!A1:{column_letter(col_count - 1)}1"
+    ))
+    header = (result.get('values') or [[]])[0]
+    if columns is None:
+        indexes = list(range(len(header)))
+    else:
+        indexes = [c for c, name in enumerate(header) if name in columns]
+    # Missing columns are kept, empty, as in select_columns.
+    missing = [name for name in columns or [] if name not in header]
+    for name in missing:
+        print(f"Column \"{name}\" not found in the sheet.")
+    yield [header[c] for c in indexes] + missing
+    if not indexes:
+        return
+
+    # Request contiguous runs of columns as single ranges.
+    runs = []
+    for c in indexes:
+        if runs and runs[-1][1] == c - 1:
+            runs[-1][1] = c
+        else:
+            runs.append([c, c])
+
+    for start in range(2, row_count + 1, sheet_window):
+        end = min(start + sheet_window - 1, row_count)
+        ranges = [
+            f"{title}!{column_letter(a)}{start}:{column_letter(b)}{end}"
+            for a, b in runs
+        ]
+        result = execute(svc.spreadsheets().values().batchGet(
+            spreadsheetId=sheet_id,
+            ranges=ranges,
+            majorDimension='ROWS',
+            fields='valueRanges.values',
+        ))
+        parts = [v.get('values', []) for v in result.get('valueRanges', [])]
+        length = max((len(v) for v in parts), default=0)
+        if not length:
+            # A run of blank rows; contacts may still follow further down.
+            continue
+        for r in range(length):
+            row = []
+            for (a, b), values in zip(runs, parts):
+                cells = values[r] if r < len(values) else []
+                row.extend(cells + [''] * (b - a + 1 - len(cells)))
+            # Drop trailing empty cells like values().get does.
+            while row and row[-1] == '':
+                row.pop()
+            yield row
+
+def column_letter(index):
+    # Convert a 0-based column index to its A1 letters (0 -> A, 26 -> AA).
+    letters = ''
+    index += 1
+    while index:
+        index, r = divmod(index - 1, 26)
+        letters = chr(ord('A') + r) + letters
+    return letters
+
+def contacts_task(sht_svc, columns, cache=None, source=None):
+    # Return the fetch_concurrently task that reads the contacts: the rows of
+    #   the sheet, or of a local "source" file (see read_source).
+    if source:
+        return (read_source, source, columns)
+    return (get_sheet, sht_svc, sheet_id, columns, cache)
+
+def read_source(path, columns=None):
+    # Read a local .csv, .vcf or .xlsx file of contacts. Like iter_sheet, the
+    #   returned iterator yields the header row and then each data row, with
+    #   only the given header "columns" (all columns if None). Rows are read
+    #   one at a time, so files of any size can be used.
+    readers = {
+        '.csv': read_csv,
+        '.vcf': read_vcard,
+        '.vcard': read_vcard,
+        '.xlsx': read_xlsx,
+    }
+    reader = readers.get(Path(path).suffix.lower())
+    if reader is None:
+        print(f"Can't read contacts from {path}; use a .csv, .vcf or .xlsx file.")
+        exit(1)
+    print(f"Reading contacts from {path}...")
+    return reader(path, columns)
+
+def select_columns(rows, columns):
+    # Yield the header and rows of "rows" restricted to "columns", renaming
+    #   headers found in column_aliases to the names used in the sheet.
+    header = next(rows, [])
+    names = {}
+    for column in contact_columns + [c for c in columns or [] if c not in contact_columns]:
+        for name in [column] + column_aliases.get(column, []):
+            names.setdefault(name.casefold(), column)
+    header = [names.get(str(name).strip().casefold(), name) for name in header]
+    if columns is None:
+        indexes = list(range(len(header)))
+    else:
+        indexes = [c for c, name in enumerate(header) if name in columns]
+    # Columns missing from the file are kept, empty, so that every contact
+    #   has the columns that the directory shows.
+    missing = [name for name in columns or [] if name not in header]
+    for name in missing:
+        print(f"Column \"{name}\" not found in the file.")
+    yield [header[c] for c in indexes] + missing
+    for row in rows:
+        yield [row[c] if c < len(row) else '' for c in indexes]
+
+def read_csv(path, columns):
+    import csv
+
+    # Exports from spreadsheets often start with a byte order mark and may
+    #   use semicolons.
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        try:
+            dialect = csv.Sniffer().sniff(f.read(64 * 1024), delimiters=',;\t')
+        except csv.Error:
+            dialect = csv.excel
+        f.seek(0)
+        yield from select_columns(csv.reader(f, dialect), columns)
+
+def read_xlsx(path, columns):
+    try:
+        import openpyxl
+    except ImportError:
+        print("Reading .xlsx files needs openpyxl (pip install openpyxl).")
+        exit(1)
+
+    # In read-only mode, rows are parsed as they are iterated.
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        if sheet_name in workbook.sheetnames:
+            sheet = workbook[sheet_name]
+        else:
+            sheet = workbook.worksheets[0]
+        rows = (
+            ['' if value is None else str(value) for value in row]
+            for row in sheet.iter_rows(values_only=True)
+        )
+        yield from select_columns(rows, columns)
+    finally:
+        workbook.close()
+
+def read_vcard(path, columns):
+    # Map each vCard onto the sheet's columns: N (or FN) gives the names,
+    #   the unit of ORG (or ORG) the team, TITLE (or ROLE) the role, and all
+    #   EMAIL and TEL values the email and phone.
+    def rows():
+        yield list(contact_columns)
+        for card in vcard_cards(path):
+            names = re.split(r'(?<!\\);', card.get('N', [''])[0])
+            if not any(names) and card.get('FN'):
+                full_name = card['FN'][0].split()
+                names = [full_name[-1], ' '.join(full_name[:-1])]
+            org = (re.split(r'(?<!\\);', card.get('ORG', [''])[0]) + [''])[:2]
+            skype = card.get('X-SKYPE', []) + card.get('X-SKYPE-USERNAME', [])
+            skype += [v[6:] for v in card.get('IMPP', []) if v.lower().startswith('skype:')]
+            values = {
+                'Team': org[1] or org[0],
+                'Role': (card.get('TITLE') or card.get('ROLE') or [''])[0],
+                'Last Name': names[0],
+                'First Name': names[1] if len(names) > 1 else '',
+                'Email': ', '.join(card.get('EMAIL', [])),
+                'Skype Name': ', '.join(skype),
+                'Phone': ', '.join(card.get('TEL', [])),
+            }
+            yield [vcard_unescape(values[c]) for c in contact_columns]
+    return select_columns(rows(), columns)
+
+def vcard_cards(path):
+    # Yield each vCard of the file as {property name: [value, ...]}; values of
+    #   structured properties (N, ORG) keep their escaped ";" separators.
+    import quopri
+
+    card = None
+    with open(path, encoding='utf-8-sig') as f:
+        for line in vcard_lines(f):
+            name, _, value = line.partition(':')
+            name, *params = name.split(';')
+            name = name.split('.')[-1].upper()
+            params = [p.upper() for p in params]
+            if name == 'BEGIN':
+                card = {}
+            elif name == 'END':
+                if card is not None:
+                    yield card
+                card = None
+            elif card is not None:
+                if 'ENCODING=QUOTED-PRINTABLE' in params or 'QUOTED-PRINTABLE' in params:
+                    charset = next((p[8:] for p in params if p.startswith('CHARSET=')), 'UTF-8')
+                    value = quopri.decodestring(value.encode()).decode(charset, 'replace')
+                card.setdefault(name, []).append(value)
+
+def vcard_lines(lines):
+    # Join folded lines: continuation lines start with a space or tab, and
+    #   vCard 2.1 quoted-printable values continue after a trailing "=".
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if current is not None and line[:1] in (' ', '\t'):
+            current += line[1:]
+        elif current is not None and current.endswith('=') and 'QUOTED-PRINTABLE' in current.upper():
+            current = current[:-1] + '=\n' + line
+        else:
+            if current:
+                yield current
+            current = line
+    if current:
+        yield current
+
+def vcard_unescape(value):
+    return re.sub(r'\\([\\,;nN])', lambda m: '\n' if m[1] in 'nN' else m[1], value)
+
+def list_files(svc, query, fields, prefetch=False):
+    # Yield pages of files matching "query", following nextPageToken. With
+    #   "prefetch", the next page is requested in the background while the
+    #   current one is being processed; only one request is in flight at a
+    #   time, so the caller's HTTP transport is never used concurrently.
+    from concurrent.futures import ThreadPoolExecutor
+
+    http = getattr(thread_state, 'http', None)
+    stage = getattr(thread_state, 'stage', None)
 
-def get_photos(svc, pics_dir_id):
+    def fetch(token):
+        thread_state.http = http
+        thread_state.stage = stage
+        return execute(svc.files().list(
+            q=query,
+            fields=f"nextPageToken, files({fields})",
+            pageSize=drive_page_size,
+            pageToken=token,
+        ))
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        results = fetch(None)
+        while True:
+            token = results.get('nextPageToken')
+            future = pool.submit(fetch, token) if token and prefetch else None
+            yield results.get('files', [])
+            if not token:
+                break
+            results = future.result() if future else fetch(token)
+
+@profiled
+def get_photos(svc, pics_dir_id, prefetch=True, cache=None):
+    # Return {name: [photo, ...]} for the photos in the folder; each photo is
+    #   a dict of its Drive id, download link, size and pixel dimensions.
     fields_list = [
-        #"id",
+        "id",
         "name",
         "size",
         "webContentLink",
+        "hasThumbnail",
+        "imageMediaMetadata(width, height)",
         #"webViewLink",
         #"iconLink",
         #"fullFileExtension",
         #"fileExtension",
     ]
-    fields = f"files({', '.join(fields_list)})"
+    if cache:
+        token = folder_token(svc, pics_dir_id)
+        photos_dict = cache.get('photos', pics_dir_id, token, extra=fields_list)
+        if photos_dict is not None:
+            return photos_dict
+    fields = ', '.join(fields_list)
     query = f"'{pics_dir_id}' in parents"
     print("Searching for photos in shared folder...")
-    results = svc.files().list(q=query, fields=fields).execute()
-    items = results.get('files', [])
     photos_dict = {}
-    for i in items:
-        name = i["name"].split('.')[0].split('_')[0]
-        try:
-            photos_dict[name][i["webContentLink"]] = int(i["size"])
-        except KeyError:
-            photos_dict[name] = {i["webContentLink"]: int(i["size"])}
+    count = 0
+    for items in list_files(svc, query, fields, prefetch=prefetch):
+        count += len(items)
+        for i in items:
+            name = i["name"].split('.')[0].split('_')[0]
+            meta = i.get("imageMediaMetadata", {})
+            photo = {
+                'id': i["id"],
+                'link': i["webContentLink"],
+                'size': int(i["size"]),
+                'width': meta.get("width"),
+                'height': meta.get("height"),
+                'thumbnail': i.get("hasThumbnail", False),
+            }
+            try:
+                photos_dict[name].append(photo)
+            except KeyError:
+                photos_dict[name] = [photo]
+    print(f"Found {count} photos for {len(photos_dict)} people.")
+    if cache:
+        cache.put('photos', pics_dir_id, token, photos_dict, extra=fields_list)
 
     return photos_dict
 
-def create_abook(rows, photos):
+class ResponseCache:
+    """On-disk cache of API responses. Entries are keyed by object ID and
+    only returned while the object's change token is unchanged; the least
+    recently used entries are evicted beyond the size limits."""
+
+    def __init__(self, path=None, dr_svc=None):
+        self.path = Path(path or cache_dir / 'responses')
+        # Drive service used to check sheet freshness.
+        self.dr_svc = dr_svc
+
+    def entry(self, kind, obj_id, extra=None):
+        name = f"{kind}-{obj_id}"
+        if extra is not None:
+            digest = hashlib.sha1(json.dumps(extra).encode()).hexdigest()
+            name += f"-{digest[:10]}"
+        return self.path / f"{name}.json"
+
+    def get(self, kind, obj_id, token, extra=None):
+        path = self.entry(kind, obj_id, extra)
+        if token is None or not path.is_file():
+            return None
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except ValueError:
+            return None
+        if entry['token'] != token:
+            return None
+        # Mark as recently used.
+        path.touch()
+        print(f"Using cached {kind} for {obj_id}.")
+        return entry['data']
+
+    def put(self, kind, obj_id, token, data, extra=None):
+        if token is None:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.entry(kind, obj_id, extra)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump({'token': token, 'data': data}, f)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.path.glob('*.json'):
+            try:
+                entries.append((path.stat(), path))
+            except FileNotFoundError:
+                # Removed by another thread or process.
+                pass
+        entries.sort(key=lambda e: e[0].st_mtime, reverse=True)
+        total = 0
+        for i, (stat, path) in enumerate(entries):
+            total += stat.st_size
+            if i >= cache_max_entries or total > cache_max_bytes:
+                path.unlink(missing_ok=True)
+
+def doc_token(svc, doc_id):
+    # The document's revisionId changes with every edit.
+    result = execute(svc.documents().get(documentId=doc_id, fields='revisionId'))
+    return result.get('revisionId')
+
+def drive_token(svc, file_id):
+    # Drive's version increases with every change to the file.
+    result = execute(svc.files().get(fileId=file_id, fields='version,modifiedTime'))
+    return f"{result.get('version')}/{result.get('modifiedTime')}"
+
+def folder_token(svc, folder_id):
+    # A folder's own version doesn't always change when files are added to it,
+    #   so also include the most recent change among its files.
+    result = execute(svc.files().list(
+        q=f"'{folder_id}' in parents",
+        orderBy='modifiedTime desc',
+        pageSize=1,
+        fields='files(id,modifiedTime)',
+    ))
+    newest = result.get('files') or [{}]
+    return f"{drive_token(svc, folder_id)}/{newest[0].get('id')}/{newest[0].get('modifiedTime')}"
+
+class Contact:
+    """One contact of the directory. "values" is the contact's sheet row and
+    "columns" maps header names to positions in it; all contacts of a sheet
+    share the same map. "photo" is the URI of the photo to show, or None."""
+
+    __slots__ = ('columns', 'values', 'photo')
+
+    def __init__(self, columns, values, photo=None):
+        self.columns = columns
+        self.values = values
+        self.photo = photo
+
+    def __getitem__(self, column):
+        i = self.columns[column]
+        # Trailing empty cells are missing from the rows the API returns.
+        return self.values[i] if i < len(self.values) else ''
+
+    def get(self, column, default=None):
+        if column not in self.columns:
+            return default
+        return self[column]
+
+    @property
+    def name(self):
+        return f"{self['Last Name']}, {self['First Name']}"
+
+    def __repr__(self):
+        return f"Contact({self.name!r})"
+
+@profiled
+def create_abook(rows, photos, report=None):
     # Take data output from spreadsheet and build contacts dictionary.
+    #   "rows" can be any iterable whose first item is the header row. If a
+    #   "report" dict is given, it lists the contacts by how their photos
+    #   were found (see PhotoIndex.match).
     abook = {}
-    for row in rows[1:]:
-        # Pad rows if not enough data.
-        full_length = 8
-        if len(row) == 1:
+    rows = iter(rows)
+    header = next(rows, [])
+    columns = {name: i for i, name in enumerate(header)}
+    last = columns['Last Name']
+    first = columns['First Name']
+    index = PhotoIndex(photos, load_photo_aliases())
+    if report is not None:
+        for how in ('exact', 'alias', 'normalized', 'suggested', 'unmatched'):
+            report[how] = []
+    for row in rows:
+        row = tuple(row)
+        last_name = row[last] if last < len(row) else ''
+        first_name = row[first] if first < len(row) else ''
+        if not last_name and not first_name:
             # Heading row (e.g. "Admin/Coordinators"); skip it.
             continue
-        elif len(row) < full_length:
-            row += [''] * (full_length - len(row))
-        # Use data from all columns.
-        full_name = f"{row[3]}, {row[4]}"
-        abook[full_name] = {}
-        for c in range(len(row)):
-            abook[full_name][rows[0][c]] = row[c]
-        try:
-            # List all photo links.
-            abook[full_name]['photo'] = photos[full_name]
-        except KeyError:
-            print(f"Check the spelling for {full_name} in the pictures folder.")
-            abook[full_name]['photo'] = None
+        full_name = f"{last_name}, {first_name}"
+        photo_name, how = index.match(full_name)
+        if photo_name is None:
+            suggestion = index.suggest(full_name)
+            if suggestion:
+                how = 'suggested'
+                photo_name, score = suggestion
+                print(f"Check the spelling for {full_name} in the pictures folder (closest: {photo_name}).")
+                if report is not None:
+                    report[how].append((full_name, photo_name, round(score, 2)))
+            else:
+                how = 'unmatched'
+                print(f"Check the spelling for {full_name} in the pictures folder.")
+                if report is not None:
+                    report[how].append(full_name)
+            photo = None
+        else:
+            if report is not None:
+                report[how].append((full_name, photo_name))
+            # Pick the photo to show now, once per contact.
+            photo = contact_photo(photos[photo_name])
+        abook[full_name] = Contact(columns, row, photo)
     return abook
 
-def send_requests(svc, doc_id, requests):
-    response = svc.documents().batchUpdate(
-        documentId=doc_id,
-        body = {'requests': requests}
-    ).execute()
+def normalize_name(name):
+    # Compare names without case, accents, punctuation or word order, so that
+    #   "Lévy,  Anne" and "anne levy" are the same name.
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c)).casefold()
+    return ' '.join(sorted(re.findall(r'\w+', name)))
+
+def name_trigrams(name):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class PhotoIndex:
+    """Find the photos of contacts by name. "photos" is {photo name: [photo,
+    ...]} as returned by get_photos, "aliases" is {contact name: photo name}.
+    Near misses are looked up through the trigrams of the normalized names,
+    so a contact is only compared with photos whose names share some."""
+
+    def __init__(self, photos, aliases=None):
+        self.photos = photos
+        self.aliases = aliases or {}
+        self.names = {}
+        self.trigrams = {}
+        for photo_name in photos:
+            name = normalize_name(photo_name)
+            self.names.setdefault(name, photo_name)
+            for trigram in name_trigrams(name):
+                self.trigrams.setdefault(trigram, []).append(name)
+
+    def match(self, contact_name):
+        # Return the name of the contact's photos and how it was found, or
+        #   (None, None).
+        if contact_name in self.photos:
+            return contact_name, 'exact'
+        alias = self.aliases.get(contact_name)
+        if alias in self.photos:
+            return alias, 'alias'
+        name = normalize_name(contact_name)
+        if name in self.names:
+            return self.names[name], 'normalized'
+        return None, None
+
+    def suggest(self, contact_name, candidates=10):
+        # Return the most similar photo name and its similarity, if any is at
+        #   least photo_match_cutoff similar. Only the "candidates" names that
+        #   share the most trigrams with the contact's are compared.
+        import collections
+        import difflib
+
+        name = normalize_name(contact_name)
+        # Trigrams found in most names say little, so skip those while there
+        #   are rarer ones.
+        postings = sorted((self.trigrams.get(t, ()) for t in name_trigrams(name)), key=len)
+        common = len(self.names) // 10 + 10
+        postings = [p for p in postings if len(p) <= common] or postings[:1]
+        shared = collections.Counter()
+        for names in postings:
+            shared.update(names)
+        best = None
+        for other, count in shared.most_common(candidates):
+            score = difflib.SequenceMatcher(None, name, other).ratio()
+            if score >= photo_match_cutoff and (best is None or score > best[1]):
+                best = (self.names[other], score)
+        return best
+
+def load_photo_aliases():
+    try:
+        with open(photo_aliases_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_photo_aliases(aliases):
+    tmp = photo_aliases_file.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(aliases, f, indent=2, sort_keys=True, ensure_ascii=False)
+    os.replace(tmp, photo_aliases_file)
+
+def confirm_suggestions(suggested, names):
+    # Return {contact name: photo name} for the suggested matches of the
+    #   contacts in "names", or, if none are listed, for those the user
+    #   accepts when asked.
+    if names:
+        confirmed = {name: photo for name, photo, score in suggested if name in names}
+        for name in names:
+            if name not in confirmed:
+                print(f"No suggested match for \"{name}\".")
+        return confirmed
+    confirmed = {}
+    for name, photo, score in suggested:
+        answer = input(f"Use {photo} for {name} ({score})? [y/N] ")
+        if answer.strip().lower() in ('y', 'yes'):
+            confirmed[name] = photo
+    return confirmed
+
+def print_match_report(report, photos):
+    # Summarize the matches found by create_abook, then list what needs to
+    #   be checked: suggested matches, contacts without photos, and photos
+    #   that no contact uses.
+    found = sum(len(report[how]) for how in ('exact', 'alias', 'normalized'))
+    total = found + len(report['suggested']) + len(report['unmatched'])
+    print(
+        f"Photos found for {found} of {total} contacts ({len(report['exact'])} "
+        f"exact, {len(report['alias'])} by alias, {len(report['normalized'])} "
+        f"by normalized name)."
+    )
+    if report['suggested']:
+        print("Suggested matches (confirm them with \"match --save\"):")
+        for name, photo_name, score in report['suggested']:
+            print(f"  {name} -> {photo_name} ({score})")
+    if report['unmatched']:
+        print("No photo found for:")
+        for name in report['unmatched']:
+            print(f"  {name}")
+    used = {match[1] for how in ('exact', 'alias', 'normalized', 'suggested') for match in report[how]}
+    unused = sorted(set(photos) - used)
+    if unused:
+        print("Photos not matched to any contact:")
+        for photo_name in unused:
+            print(f"  {photo_name}")
+
+class TokenBucket:
+    """Allow "rate" calls per second on average, with bursts of up to
+    "capacity" calls. Safe to share between threads."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+docs_write_bucket = TokenBucket(docs_write_rate, docs_write_burst)
+
+# Credentials of the services built by build_services (see get_creds), and
+#   per-thread state.
+credentials = None
+thread_state = threading.local()
+
+def is_transient(error):
+    # Decide whether an error from execute() is worth retrying.
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    from googleapiclient.errors import HttpError
+    if isinstance(error, HttpError):
+        if error.resp.status in retry_statuses:
+            return True
+        # Quota errors are sometimes reported as "403 rateLimitExceeded".
+        return error.resp.status == 403 and b'ateLimitExceeded' in error.content
+    return False
+
+def is_revision_mismatch(error):
+    # Docs rejects a batchUpdate whose writeControl.requiredRevisionId isn't
+    #   the document's current revision with "400 Bad Request".
+    from googleapiclient.errors import HttpError
+    return isinstance(error, HttpError) and error.resp.status == 400
+
+def worker_http():
+    # Return a new authorized Http object for a worker thread, since httplib2
+    #   connections can't be shared between threads.
+    if credentials is None:
+        return None
+    from googleapiclient.http import build_http
+    from google_auth_httplib2 import AuthorizedHttp
+    return AuthorizedHttp(credentials.get(), http=build_http())
+
+def execute(request, bucket=None, applied=None):
+    # Execute an API request, waiting for quota and retrying transient errors.
+    #   Worker threads use their own HTTP transport (see fetch_concurrently).
+    #   If a retry fails and applied(error) is true, an earlier attempt took
+    #   effect although its reply was lost, and None is returned.
+    http = getattr(thread_state, 'http', None)
+    start = time.monotonic()
+    for attempt in range(max_retries + 1):
+        if bucket:
+            bucket.acquire()
+        if credentials:
+            # Refresh the shared token before it expires, not after.
+            credentials.get()
+        try:
+            if http:
+                result = request.execute(http=http)
+            else:
+                result = request.execute()
+            break
+        except Exception as e:
+            if attempt and applied and not is_transient(e) and applied(e):
+                result = None
+                break
+            if attempt == max_retries or not is_transient(e):
+                raise
+            delay = random.uniform(0, min(max_backoff, 2 ** attempt))
+            print(f"Request failed ({e}); retrying in {delay:.1f}s...")
+            time.sleep(delay)
+    if profile:
+        profile.add_call(request, result, time.monotonic() - start, attempt)
+    return result
+
+
+def chunk_requests(requests, max_requests=None, max_bytes=None):
+    # Split requests into batches that respect the request count and payload
+    #   size limits. Every index is computed as if all earlier requests were
+    #   applied, and batches are applied in order, so a batch can end after
+    #   any request.
+    max_requests = max_requests or max_batch_requests
+    max_bytes = max_bytes or max_batch_bytes
+    chunk = []
+    chunk_bytes = 0
+    for request in requests:
+        # Size of the request in the JSON list of the batch, with its
+        #   separator.
+        request_bytes = len(json.dumps(request)) + 2
+        if chunk and (len(chunk) == max_requests
+                      or chunk_bytes + request_bytes > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(request)
+        chunk_bytes += request_bytes
+    if chunk:
+        yield chunk
+
+@profiled
+def send_requests(svc, doc_id, requests, journal=None, revision=None):
+    # Send requests in as many batches as needed; return the combined replies.
+    #   Each batch sent is recorded in "journal", if given. If the document's
+    #   "revision" is given, each batch only applies to the revision left by
+    #   the previous one, so that a batch retried after its reply was lost
+    #   isn't applied twice.
+    response = {'documentId': doc_id, 'replies': []}
+    start = time.monotonic()
+    sent = 0
+    batches = 0
+
+    def applied(error):
+        # The retry was rejected because an earlier attempt changed the
+        #   revision; a malformed batch leaves it as it was.
+        return is_revision_mismatch(error) and doc_token(svc, doc_id) != revision
+
+    for chunk in chunk_requests(requests):
+        body = {'requests': chunk}
+        if revision:
+            body['writeControl'] = {'requiredRevisionId': revision}
+        result = execute(
+            svc.documents().batchUpdate(
+                documentId=doc_id,
+                body = body
+            ),
+            bucket=docs_write_bucket,
+            applied=applied if revision else None
+        )
+        if result is None:
+            print(f"Batch of {len(chunk)} requests was applied before its reply was lost.")
+            result = {
+                'replies': [{} for r in chunk],
+                'writeControl': {'requiredRevisionId': doc_token(svc, doc_id)},
+            }
+        response['replies'].extend(result.get('replies', []))
+        if 'writeControl' in result:
+            response['writeControl'] = result['writeControl']
+            revision = result['writeControl'].get('requiredRevisionId')
+        if journal:
+            journal.commit(len(chunk), revision)
+        sent += len(chunk)
+        batches += 1
+    if batches > 1:
+        elapsed = time.monotonic() - start
+        print(
+            f"Sent {sent} requests in {batches} batches "
+            f"({sent / max(elapsed, 0.001):.1f} requests/s)."
+        )
     return response
 
-def table_insert(index):
-    # Insert a "row" (actually a  table of 2 rows x 3 columns) at the end of the document.
+class UpdateJournal:
+    """Checkpoint of a document update in progress: the requests to send,
+    appended to a file as they are generated, and in a separate small file
+    how many of them the document has received, the revision it had then,
+    and whether all requests were recorded."""
+
+    def __init__(self, doc_id):
+        self.path = journal_dir / f"{doc_id}.json"
+        self.requests_path = journal_dir / f"{doc_id}.requests.jsonl"
+        self.sent = 0
+        self.revision = None
+        self.total = None
+
+    def load(self):
+        # Return the saved state, or None if no update is in progress.
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        self.sent = state['sent']
+        self.revision = state['revision']
+        self.total = state['total']
+        return state
+
+    def requests(self):
+        # Yield the recorded requests that weren't sent yet.
+        with open(self.requests_path) as f:
+            for line in itertools.islice(f, self.sent, None):
+                yield json.loads(line)
+
+    def start(self, revision):
+        journal_dir.mkdir(parents=True, exist_ok=True)
+        self.sent = 0
+        self.revision = revision
+        self.total = None
+        self.save()
+
+    def record(self, requests):
+        # Yield "requests", recording each one first. The total is saved once
+        #   all are recorded; until then the update can't be resumed.
+        total = 0
+        with open(self.requests_path, 'w') as f:
+            for request in requests:
+                f.write(json.dumps(request) + '\n')
+                total += 1
+                yield request
+        self.total = total
+        self.save()
+
+    def commit(self, count, revision):
+        self.sent += count
+        self.revision = revision
+        self.save()
+
+    def save(self):
+        state = {'sent': self.sent, 'revision': self.revision, 'total': self.total}
+        tmp = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    def finish(self):
+        # The update is complete (or abandoned); forget it.
+        for path in (self.path, self.requests_path):
+            path.unlink(missing_ok=True)
+
+def resume_update(svc, doc_id):
+    # Send the rest of an interrupted update of the document, unless the
+    #   document was edited since or the update stopped before all of its
+    #   requests were generated. Return True if an update was resumed, None
+    #   in the latter case, when the document may hold part of the update.
+    journal = UpdateJournal(doc_id)
+    if journal.load() is None:
+        return False
+    if journal.total is None:
+        print("Last update was interrupted before it was fully planned; updating again.")
+        journal.finish()
+        return None
+    if doc_token(svc, doc_id) != journal.revision:
+        print("Document changed since the last update was interrupted; starting over.")
+        journal.finish()
+        return False
+    print(
+        f"Resuming interrupted update ({journal.sent} of {journal.total} "
+        f"requests already sent)..."
+    )
+    send_requests(
+        svc, doc_id, journal.requests(), journal=journal, revision=journal.revision
+    )
+    journal.finish()
+    print("Done.")
+    return True
+
+def table_insert(index, rows=2, columns=3):
+    # Insert a table of "rows" x "columns" after a newline inserted at "index".
     request = {
         "insertTable": {
-            "rows": 2,
-            "columns": 3,
+            "rows": rows,
+            "columns": columns,
             "location": {
                 'index': index
             }
@@ -368,74 +2171,11 @@ def table_insert(index):
     return request
 
 def table_update_borders(start):
+    # Hide the borders of the table at "start". All tables share one style
+    #   dict, which must not be modified.
     request = {
         "updateTableCellStyle": {
-            "tableCellStyle": {
-                "borderLeft": {
-                    "color": {
-                        "color": {
-                            "rgbColor": {
-                                "blue": 0.0,
-                                "green": 0.0,
-                                "red": 0.0,
-                            },
-                        },
-                    },
-                    "dashStyle": 'SOLID',
-                    "width": {
-                        "magnitude": 0.0,
-                        "unit": 'PT'
-                    },
-                },
-                "borderRight": {
-                    "color": {
-                        "color": {
-                            "rgbColor": {
-                                "blue": 0.0,
-                                "green": 0.0,
-                                "red": 0.0,
-                            },
-                        },
-                    },
-                    "dashStyle": 'SOLID',
-                    "width": {
-                        "magnitude": 0.0,
-                        "unit": 'PT'
-                    },
-                },
-                "borderTop": {
-                    "color": {
-                        "color": {
-                            "rgbColor": {
-                                "blue": 0.0,
-                                "green": 0.0,
-                                "red": 0.0,
-                            },
-                        },
-                    },
-                    "dashStyle": 'SOLID',
-                    "width": {
-                        "magnitude": 0.0,
-                        "unit": 'PT'
-                    },
-                },
-                "borderBottom": {
-                    "color": {
-                        "color": {
-                            "rgbColor": {
-                                "blue": 0.0,
-                                "green": 0.0,
-                                "red": 0.0,
-                            },
-                        },
-                    },
-                    "dashStyle": 'SOLID',
-                    "width": {
-                        "magnitude": 0.0,
-                        "unit": 'PT'
-                    },
-                },
-            },
+            "tableCellStyle": no_borders,
             "fields": '*',
             "tableStartLocation": {
                 "index": start,
@@ -444,12 +2184,35 @@ def table_update_borders(start):
     }
     return request
 
+no_border = {
+    "color": {
+        "color": {
+            "rgbColor": {
+                "blue": 0.0,
+                "green": 0.0,
+                "red": 0.0,
+            },
+        },
+    },
+    "dashStyle": 'SOLID',
+    "width": {
+        "magnitude": 0.0,
+        "unit": 'PT'
+    },
+}
+no_borders = {
+    "borderLeft": no_border,
+    "borderRight": no_border,
+    "borderTop": no_border,
+    "borderBottom": no_border,
+}
+
 def table_update_format(start_index, end_index):
     request = {
         "updateTextStyle": {
             "range": {
-                "startIndex": 12,
-                "endIndex": 17,
+                "startIndex": start_index,
+                "endIndex": end_index,
             },
             "textStyle": {
                 "fontSize": {
@@ -462,139 +2225,139 @@ def table_update_format(start_index, end_index):
     }
     return request
 
-def create_output_rows(abook):
-    # Add rows as necessary, populate contact data into each row.
+@profiled
+def create_output_sections(abook, width=None):
+    # Return the sections of the directory, one per team in section order,
+    #   each an iterator over rows of up to "width" contacts.
+    # Group the contacts in a single pass; dicts keep first-seen team order.
     teams = {}
-    for p in abook:
-        try:
-            teams[abook[p]['Team']].append(p)
-        except KeyError:
-            teams[abook[p]['Team']] = [p]
+    for contact in abook.values():
+        teams.setdefault(contact['Team'], []).append(contact)
+
+    order = [t for t in section_order if t in teams]
+    order += [t for t in teams if t not in section_order]
+    return [section_rows(teams[t], section_sort_keys.get(t, default_sort_key), width)
+            for t in order]
 
-    # Create list of 3-item rows with all relevant info.
+def section_rows(members, sort_key=None, width=None):
+    # Yield "members" in rows of up to "width" contacts, sorted by the values
+    #   of the "sort_key" columns if given.
+    width = width or row_width
+    if sort_key:
+        members = sorted(members, key=lambda c: [c.get(k, '').casefold() for k in sort_key])
+    for i in range(0, len(members), width):
+        yield members[i:i + width]
+
+def contact_text(contact):
+    # Define contact info variables.
+    full_name = contact.name
+    team = contact['Team']
+    title = contact['Role']
+    emails = f"{contact['Email']}"
+    skype = contact['Skype Name']
+    phones = f"{contact['Phone']}\n"
+
+    # Organize contact data.
     rows = []
-    sections = []
-    for team, members in teams.items():
-        # TODO: This is where the rows would be force-sorted.
-        # Handle Admin first.
-        if team == "Admin":
-            sections.insert(0, {team: members})
-        elif team == "Finance":
-            sections.insert(1, {team: members})
+    if full_name:
+        rows.append(full_name)
+    if team and title:
+        title_row = f"{team}, {title}"
+        rows.append(title_row)
+    if emails:
+        email_row = f"Email:\n {emails}"
+        rows.append(email_row)
+    if skype:
+        skype_row = f"Skype:\n {skype}"
+        rows.append(skype_row)
+    if phones:
+        phone_row = f"Phone:\n {phones}"
+        rows.append(phone_row)
+    return '\n'.join(rows)
+
+def contact_photo(photos):
+    # Select the smallest rendition of a contact's photos that is still
+    #   sharp at display size, so that Docs doesn't have to fetch full-size
+    #   originals: either an original that is small enough, or a thumbnail
+    #   that Drive renders at the needed size from a larger original.
+    if not photos:
+        return None
+    pixels = math.ceil(photo_size * photo_dpi / 72)
+    renditions = []
+    for photo in photos:
+        if not photo['width'] or not photo['height']:
+            # Dimensions unknown; prefer the largest file, as before.
+            renditions.append((float('inf'), -photo['size'], photo['link']))
+            continue
+        side = max(photo['width'], photo['height'])
+        if side > pixels and photo['thumbnail']:
+            link = f"https://drive.google.com/thumbnail?id={photo['id']}&sz=w{pixels}"
+            renditions.append((pixels, 0, link))
         else:
-            sections.append({team: members})
-
-    for section in sections:
-        for team, members in section.items():
-            sec_rows = []
-            sec_row_ct = len(members) // 3 + 1
-            for i, member in enumerate(members):
-                ind = i // 3
-                try:
-                    sec_rows[ind].append(member)
-                except IndexError:
-                    sec_rows.insert(ind, [member])
-            rows.append(sec_rows)
-
-    output_rows = []
-    for section in rows:
-        for row in section:
-            # Create a new row to send to output.
-            output_rows.append(row)
-
-    final_rows = []
-    for names_row in output_rows:
-        abook_row = []
-        for n in names_row:
-            abook_row.append(abook[n])
-        final_rows.append(abook_row)
-
-    return final_rows
-
-def row_data(row, last_cell_index):
+            renditions.append((side, photo['size'], photo['link']))
+    sharp = [r for r in renditions if r[0] >= pixels]
+    if sharp:
+        return min(sharp)[2]
+    return max(renditions)[2]
+
+def utf16_len(text):
+    # Docs indexes count UTF-16 code units.
+    return len(text.encode('utf-16-le')) // 2
+
+@profiled
+def row_data(row, index):
+    # Fill the two table rows of one row of contacts: photos first, then
+    #   contact details. "index" is the first photo cell's paragraph; each
+    #   insertion shifts the following cells by its length. Return the
+    #   requests and the index of the paragraph after the text row.
     requests = []
-    people_in_row = len(row)
-
-    # Insert text first.
-    for i in range(people_in_row):
-        # Set position "pos_from_right" so that entries are justified to the
-        #   beginning of the row rather than to the end.
-        pos_from_right = i + 3 - people_in_row
-        # text_index is 12, 14, or 16
-        text_index = last_cell_index - 2 * pos_from_right
-
-        # Define contact info variables.
-        full_name = f"{row[i]['Last Name']}, {row[i]['First Name']}"
-        team = row[i]['Team']
-        title = row[i]['Role']
-        emails = f"{row[i]['Email']}"
-        skype = row[i]['Skype Name']
-        phones = f"{row[i]['Phone']}\n"
-
-        # Organize contact data.
-        rows = []
-        if full_name:
-            rows.append(full_name)
-        if team and title:
-            title_row = f"{team}, {title}"
-            rows.append(title_row)
-        if emails:
-            email_row = f"Email:\n {emails}"
-            rows.append(email_row)
-        if skype:
-            skype_row = f"Skype:\n {skype}"
-            rows.append(skype_row)
-        if phones:
-            phone_row = f"Phone:\n {phones}"
-            rows.append(phone_row)
-        text = '\n'.join(rows)
-        requests.append({
-            'insertText': {
-                "text": text,
-                "location": {
-                    "index": text_index
-                }
-            }
-        })
 
-    # Insert photos last.
-    for i in range(people_in_row):
-        pos_from_right = i + 3 - people_in_row
-        # photo_index is 5, 7, or 9
-        photo_index = last_cell_index - 7 - 2 * pos_from_right
-        photo_links = row[i]['photo']
-
-        # Select largest available photo.
-        sizes = [v for v in photo_links.values()]
-        sizes.sort(reverse=True)
-        photo_link = None
-        for link, size in photo_links.items():
-            if sizes[0] == size:
-                photo_link = link
-
-        if not photo_link:
-            print(f"No photo for {row[i]['Last Name']}, {row[i]['First Name']}.")
-            # Use placeholder image if photo isn't found.
-            photo_link = 'https://drive.google.com/uc?id=1JE7lhkcRWPf0yrasVHu9S0qPWidsktvy&export=download'
-        requests.append({
-            'insertInlineImage': {
-                'location': {
-                    'index': photo_index
-                },
-                'uri': photo_link,
-                'objectSize': {
-                    'height': {
-                        'magnitude': 140,
-                        'unit': 'PT'
+    # Insert photos.
+    for i in range(row_width):
+        length = 0
+        if i < len(row):
+            if not row[i].photo:
+                print(f"No photo for {row[i].name}.")
+            requests.append({
+                'insertInlineImage': {
+                    'location': {
+                        'index': index
                     },
-                    'width': {
-                        'magnitude': 140,
-                        'unit': 'PT'
+                    # Use placeholder image if photo isn't found.
+                    'uri': row[i].photo or placeholder_photo,
+                    'objectSize': square_size(photo_size),
+                }
+            })
+            length = 1
+        # Skip past the cell's newline and the next cell's start.
+        index += length + 2
+    # Skip the start of the text row.
+    index += 1
+
+    # Insert text.
+    for i in range(row_width):
+        length = 0
+        if i < len(row):
+            text = contact_text(row[i])
+            requests.append({
+                'insertText': {
+                    "text": text,
+                    "location": {
+                        "index": index
                     }
                 }
-            }
-        })
-    return requests
+            })
+            length = utf16_len(text)
+        index += length + 2
+    index += 1
+    return requests, index
+
+@functools.lru_cache()
+def square_size(points):
+    # Return the objectSize of a square image; photos of the same size share
+    #   one dict, which must not be modified.
+    side = {'magnitude': points, 'unit': 'PT'}
+    return {'height': side, 'width': side}
 
 def add_photo(link, index):
     requests = [{
@@ -619,25 +2382,18 @@ def add_photo(link, index):
     return requests
 
 
-def delete_all(svc, doc_id, end):
-    response = None
-    if end > 1:
-        requests = [
-            {
-                "deleteContentRange": {
-                    "range": {
-                        "startIndex": 1,
-                        "endIndex": end,
-                    }
-                }
+def delete_request(start, end):
+    request = {
+        "deleteContentRange": {
+            "range": {
+                "startIndex": start,
+                "endIndex": end,
             }
-        ]
-        response = svc.documents().batchUpdate(
-            documentId = doc_id,
-            body = {'requests': requests}
-        ).execute()
-    return response
+        }
+    }
+    return request
 
+@profiled
 def delete_range(svc, doc_id, start, end):
     requests = [{
         "deleteContentRange": {
@@ -647,12 +2403,10 @@ def delete_range(svc, doc_id, start, end):
             }
         }
     }]
-    response = svc.documents().batchUpdate(
-        documentId = doc_id,
-        body = {'requests': requests}
-    ).execute()
+    response = send_requests(svc, doc_id, requests)
     return response
 
+@profiled
 def delete_row(svc, doc_id, start, i_row, i_col):
     requests = [
         {
@@ -667,16 +2421,289 @@ def delete_row(svc, doc_id, start, i_row, i_col):
             }
         }
     ]
-    response = svc.documents().batchUpdate(
-        documentId = doc_id,
-        body = {'requests': requests}
-    ).execute()
+    response = send_requests(svc, doc_id, requests)
     return response
 
+def watch(svc, on_change, cache=None):
+    # Poll the Drive change feed and call on_change() once changes to the
+    #   sheet or the photo folder have stopped for watch_debounce seconds. The
+    #   feed's page token is saved after every poll, together with whether an
+    #   update is still pending, so a restart resumes where it stopped.
+    state = {}
+    if watch_state_file.is_file():
+        with open(watch_state_file) as f:
+            state = json.load(f)
+    if not state.get('token'):
+        result = execute(svc.changes().getStartPageToken())
+        state = {'token': result['startPageToken'], 'pending': False}
+    photo_ids = watched_photo_ids(svc, cache)
+    last_change = time.monotonic() if state['pending'] else None
+    print(f"Watching for changes every {watch_interval}s (Ctrl+C to stop)...")
+    while True:
+        changes, state['token'] = list_changes(svc, state['token'])
+        relevant = [c for c in changes if is_relevant_change(c, photo_ids)]
+        if relevant:
+            print(f"{len(relevant)} relevant changes; waiting for edits to settle...")
+            last_change = time.monotonic()
+            state['pending'] = True
+        save_watch_state(state)
+
+        if state['pending'] and time.monotonic() - last_change >= watch_debounce:
+            try:
+                on_change()
+                photo_ids = watched_photo_ids(svc, cache)
+                state['pending'] = False
+                save_watch_state(state)
+            except Exception as e:
+                print(f"Update failed ({e!r}); will try again.")
+                last_change = time.monotonic()
+        time.sleep(watch_interval)
+
+def list_changes(svc, token):
+    # Return the changes since "token" and the token to use next time.
+    changes = []
+    while True:
+        result = execute(svc.changes().list(
+            pageToken=token,
+            pageSize=drive_page_size,
+            includeRemoved=True,
+            fields='nextPageToken,newStartPageToken,'
+                   'changes(fileId,removed,file(parents,trashed))',
+        ))
+        changes.extend(result.get('changes', []))
+        if 'newStartPageToken' in result:
+            return changes, result['newStartPageToken']
+        token = result['nextPageToken']
+
+def is_relevant_change(change, photo_ids):
+    # Changes to the sheet, or to files in (or removed from) the photo folder.
+    if change.get('fileId') == sheet_id or change.get('fileId') in photo_ids:
+        return True
+    return pics_dir_id in change.get('file', {}).get('parents', [])
+
+def watched_photo_ids(svc, cache=None):
+    # IDs of the files in the photo folder, to notice when one is deleted.
+    photos = get_photos(svc, pics_dir_id, cache=cache)
+    return {photo['id'] for group in photos.values() for photo in group}
+
+def save_watch_state(state):
+    watch_state_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = watch_state_file.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, watch_state_file)
+
+def export_directory(svc, doc_id, path):
+    # Export the directory in "doc_id" to "path". A directory split into parts
+    #   (see update_shards) is exported a part at a time, to "x-1.pdf",
+    #   "x-2.pdf", ... for a "path" of "x.pdf".
+    state = load_shards().get(doc_id, {})
+    parts = state.get('parts', 0)
+    if not parts:
+        export_pdf(svc, doc_id, path)
+        return
+    stem = path[:-len('.pdf')] if path.endswith('.pdf') else path
+    for i, entry in enumerate(state['shards'][:parts]):
+        export_pdf(svc, entry['id'], f"{stem}-{i + 1}.pdf")
+
+@profiled
+def export_pdf(svc, doc_id, path):
+    # Stream the document's PDF export to "path" in export_chunk_size chunks,
+    #   so memory use doesn't grow with the file. A chunk that fails is
+    #   retried from where the download stopped. Drive only exports documents
+    #   up to 10 MB.
+    from googleapiclient.http import MediaIoBaseDownload
+
+    print(f"Exporting {doc_id} to {path}...")
+    request = svc.files().export_media(fileId=doc_id, mimeType='application/pdf')
+    http = getattr(thread_state, 'http', None)
+    if http:
+        request.http = http
+    part = Path(f"{path}.part")
+    start = time.monotonic()
+    with open(part, 'wb') as f:
+        downloader = MediaIoBaseDownload(f, request, chunksize=export_chunk_size)
+        done = False
+        attempt = 0
+        while not done:
+            try:
+                status, done = downloader.next_chunk()
+                attempt = 0
+            except Exception as e:
+                if attempt == max_retries or not is_transient(e):
+                    raise
+                delay = random.uniform(0, min(max_backoff, 2 ** attempt))
+                print(f"Download failed ({e}); resuming in {delay:.1f}s...")
+                time.sleep(delay)
+                attempt += 1
+        size = f.tell()
+    os.replace(part, path)
+    elapsed = time.monotonic() - start
+    print(
+        f"Saved {path} ({size / 2 ** 20:.1f} MB in {elapsed:.1f}s, "
+        f"{size / 2 ** 20 / max(elapsed, 0.001):.1f} MB/s)."
+    )
+
+@profiled
+def render_directory(abook, path, svc=None, use_cache=True):
+    # Render the directory with the same layout as update_doc to a local HTML
+    #   file, or to PDF with WeasyPrint, without using the Docs API. Photos
+    #   are embedded in the file, so it can be copied anywhere.
+    if path.endswith('.pdf'):
+        try:
+            from weasyprint import HTML
+        except ImportError:
+            print("Rendering PDF files needs WeasyPrint (pip install weasyprint).")
+            exit(1)
+    start = time.monotonic()
+    blocks = list(layout_blocks(create_output_sections(abook)))
+    uris = {c.photo or placeholder_photo for rows in blocks for row in rows for c in row}
+    images = local_images(uris, svc, use_cache)
+    document = directory_html(blocks, images)
+    if path.endswith('.pdf'):
+        HTML(string=document).write_pdf(path)
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(document)
+    elapsed = time.monotonic() - start
+    print(f"Saved {path} ({len(abook)} contacts in {elapsed:.1f}s).")
+
+def directory_html(blocks, images):
+    # Lay out each block as a table, like block_requests: a row of photos
+    #   above a row of contact details for each row of contacts.
+    import html
+
+    parts = [
+        '<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n<style>\n',
+        '@page { size: A4; margin: 20pt; }\n',
+        'body { font-family: Arial, sans-serif; font-size: 10pt; margin: 0; }\n',
+        'table { width: 100%; table-layout: fixed; border-collapse: collapse; margin-bottom: 11pt; }\n',
+        'tbody { page-break-inside: avoid; }\n',
+        'td { vertical-align: top; padding: 2pt 5pt; }\n',
+        f'img {{ width: {photo_size}pt; height: {photo_size}pt; object-fit: contain; }}\n',
+        '</style>\n</head>\n<body>\n',
+    ]
+    for rows in blocks:
+        parts.append('<table>\n')
+        for row in rows:
+            empty = ['<td></td>'] * (row_width - len(row))
+            photos = []
+            for contact in row:
+                image = images.get(contact.photo or placeholder_photo)
+                photos.append(f'<td><img src="{image}"></td>' if image else '<td></td>')
+            texts = [
+                '<td>' + html.escape(contact_text(contact)).replace('\n', '<br>') + '</td>'
+                for contact in row
+            ]
+            parts.append('<tbody><tr>' + ''.join(photos + empty) + '</tr>\n')
+            parts.append('<tr>' + ''.join(texts + empty) + '</tr></tbody>\n')
+        parts.append('</table>\n')
+    parts.append('</body>\n</html>\n')
+    return ''.join(parts)
+
+def local_images(uris, svc=None, use_cache=True):
+    # Return {uri: data URI} for the photos at "uris": local files, or Drive
+    #   files downloaded (in parallel) into thumbnail_dir unless already there.
+    #   Photos that can't be read are left out.
+    import base64
+    from concurrent.futures import ThreadPoolExecutor
+
+    def load(uri):
+        thread_state.http = worker_http()
+        try:
+            data = image_data(uri, svc, use_cache)
+        except Exception as e:
+            print(f"Couldn't get photo {uri} ({e}).")
+            return None
+        finally:
+            thread_state.http = None
+        if data is None:
+            return None
+        return f"data:{image_type(data)};base64," + base64.b64encode(data).decode()
+
+    with ThreadPoolExecutor(max_workers=render_workers) as pool:
+        uris = list(uris)
+        images = dict(zip(uris, pool.map(load, uris)))
+    return {uri: image for uri, image in images.items() if image}
+
+def image_data(uri, svc, use_cache):
+    if os.path.isfile(uri):
+        with open(uri, 'rb') as f:
+            return f.read()
+    file_id = drive_file_id(uri)
+    if file_id is None:
+        return None
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    pixels = math.ceil(photo_size * photo_dpi / 72)
+    path = thumbnail_dir / (f"{file_id}.{pixels}" if Image else file_id)
+    if use_cache and path.is_file():
+        with open(path, 'rb') as f:
+            return f.read()
+    if svc is None:
+        return None
+    data = execute(svc.files().get_media(fileId=file_id))
+    if Image:
+        # Scale the photo down to display size, as Drive thumbnails would be.
+        import io
+        image = Image.open(io.BytesIO(data))
+        image.thumbnail((pixels, pixels))
+        out = io.BytesIO()
+        image.convert('RGB').save(out, 'JPEG', quality=85)
+        data = out.getvalue()
+    if use_cache:
+        thumbnail_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return data
+
+def drive_file_id(uri):
+    # Return the file id of a Drive download or thumbnail link.
+    from urllib.parse import parse_qs, urlparse
+    ids = parse_qs(urlparse(uri).query).get('id')
+    return ids[0] if ids else None
+
+def image_type(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'GIF8'):
+        return 'image/gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'image/jpeg'
+
+def local_photos(path):
+    # Return {name: [photo, ...]} like get_photos, for the image files of a
+    #   local folder.
+    photos_dict = {}
+    for entry in os.scandir(path):
+        if not entry.is_file():
+            continue
+        name = entry.name.split('.')[0].split('_')[0]
+        photo = {
+            'id': None,
+            'link': entry.path,
+            'size': entry.stat().st_size,
+            'width': None,
+            'height': None,
+            'thumbnail': False,
+        }
+        photos_dict.setdefault(name, []).append(photo)
+    print(f"Found {sum(map(len, photos_dict.values()))} photos for {len(photos_dict)} people.")
+    return photos_dict
+
 def main():
     """Creates a Google Doc file that merges together photos and contact info
     gleaned from other shared Drive items."""
-    do_cmdline(sys.argv, infile_id=template_id, outfile_id=output_id)
+    try:
+        do_cmdline(sys.argv, infile_id=template_id, outfile_id=output_id)
+    finally:
+        if profile:
+            profile.finish()
 
 
 if __name__ == '__main__':